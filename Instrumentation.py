@@ -0,0 +1,275 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# Number of iterations between two reports of the statistics
+STATS_EVERY = 100
+# Seconds between two samples of the sampling profiler
+PROFILE_INTERVAL = 0.005
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self):
+        """
+        Total, count and maximum of the durations of a stage. Used as a context manager around the stage, a timer is not re-entrant,
+        so every thread has to time its own stages.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        return False
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1e3,
+            'mean_ms': self.total / self.count * 1e3 if self.count else 0.0,
+            'max_ms': self.max * 1e3,
+        }
+
+
+class Histogram:
+    def __init__(self):
+        """
+        Histogram of non-negative values with power of two buckets, the bucket b counts the values in [2^(b-1), 2^b)
+        """
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[int(value).bit_length()] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {str(1 << bucket): count for bucket, count in sorted(self.buckets.items())},
+        }
+
+
+class Instruments:
+    def __init__(self):
+        """
+        Timers, counters and histograms of the stages of the drive. This one records nothing, so instrumented code costs a method call
+        when the instrumentation is disabled. Values that are expensive to compute should only be computed if enabled is True.
+        """
+        self.enabled = False
+
+    def timer(self, name):
+        """
+        @param name: Name of the stage
+        @return: Context manager timing the stage
+        """
+        return NULL_TIMER
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        """
+        Adds a value to a histogram
+        """
+        pass
+
+    def report(self, iteration):
+        """
+        Reports the statistics to the sinks every few iterations
+        """
+        pass
+
+    def stats(self):
+        """
+        @return: Dict of the statistics since the start of the drive
+        """
+        return {}
+
+    def close(self):
+        pass
+
+
+class Profiler(Instruments):
+    def __init__(self, sinks=(), every=STATS_EVERY):
+        """
+        Records the timers, counters and histograms and reports them periodically
+        @param sinks: Sinks the statistics are reported to, see SINKS. Without sinks they are only available from stats
+        @param every: Number of iterations between two reports
+        """
+        super().__init__()
+        self.enabled = True
+        self.sinks = list(sinks)
+        self.every = every
+        self.timers = collections.defaultdict(Timer)
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.iteration = 0
+        self.start = time.perf_counter()
+
+    def timer(self, name):
+        return self.timers[name]
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.histograms[name].add(value)
+
+    def report(self, iteration):
+        self.iteration = iteration
+        if iteration % self.every == 0:
+            self.emit()
+
+    def emit(self):
+        stats = self.stats()
+        for sink in self.sinks:
+            sink.write(stats)
+
+    def stats(self):
+        return {
+            'iteration': self.iteration,
+            'elapsed_s': time.perf_counter() - self.start,
+            'timers': {name: timer.summary() for name, timer in list(self.timers.items())},
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary() for name, histogram in list(self.histograms.items())},
+        }
+
+    def close(self):
+        """
+        Reports the final statistics and closes the sinks
+        """
+        self.emit()
+        for sink in self.sinks:
+            sink.close()
+
+
+class LogSink:
+    def __init__(self, filename=None):
+        """
+        Prints a line with the mean duration of every stage
+        """
+
+    def write(self, stats):
+        timers = ', '.join('{} {:.2f} ms'.format(name, timer['mean_ms']) for name, timer in stats['timers'].items())
+        print("Iteration {} ({:.1f} s): {}".format(stats['iteration'], stats['elapsed_s'], timers))
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    def __init__(self, filename):
+        """
+        Appends the statistics of every report as a line of JSON
+        @param filename: Path of the file
+        """
+        if filename is None:
+            raise ValueError("The json sink needs a file")
+        self.file = open(filename, 'a')
+
+    def write(self, stats):
+        self.file.write(json.dumps(stats) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+SINKS = {
+    'log': LogSink,
+    'json': JsonLinesSink,
+}
+
+
+def make_instruments(sink=None, filename=None, every=STATS_EVERY):
+    """
+    @param sink: None to disable the instrumentation, 'memory' to only keep the statistics in process, or one of SINKS
+    @param filename: File of the sink, if it writes to one
+    @param every: Number of iterations between two reports
+    @return: Instruments
+    """
+    if sink is None or sink == 'none':
+        return Instruments()
+    if sink == 'memory':
+        return Profiler(every=every)
+    return Profiler([SINKS[sink](filename)], every=every)
+
+
+class SamplingProfiler:
+    def __init__(self, filename, interval=PROFILE_INTERVAL):
+        """
+        Samples the stacks of all the threads from a background thread, and writes the number of samples of every stack in the folded
+        format of flame graphs, one 'thread;outer;...;inner count' line per stack. Unlike cProfile, the code runs at full speed between samples.
+        @param filename: Path of the folded stacks
+        @param interval: Seconds between two samples
+        """
+        self.filename = filename
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Stops sampling and writes the folded stacks
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        with open(self.filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
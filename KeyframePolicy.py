@@ -0,0 +1,77 @@
+import numpy as np
+
+# The sensor logs are stamped in nanoseconds
+TIMESTAMP_UNIT = 1e-9
+
+
+class KeyframePolicy:
+    def __init__(self, min_distance=0.0, min_rotation=0.0, compute_budget=None):
+        """
+        Selects the stereo frames that are texture mapped. A frame is a keyframe if the vehicle moved at least min_distance or turned
+        at least min_rotation since the last keyframe, and if the texture mapping so far fits in the compute budget.
+        With the default values, every frame is a keyframe.
+
+        @param min_distance: Distance in meters since the last keyframe, 0 disables it
+        @param min_rotation: Heading change in radians since the last keyframe, 0 disables it
+        @param compute_budget: Seconds of texture mapping allowed per second of drive, None disables it
+        """
+        self.min_distance = min_distance
+        self.min_rotation = min_rotation
+        self.compute_budget = compute_budget
+
+        self.last_pose = None
+        self.start_timestamp = None
+        self.compute_time = 0.0
+        self.n_keyframes = 0
+        self.n_skipped = 0
+
+    def is_keyframe(self, timestamp, pose):
+        """
+        @param timestamp: Timestamp of the frame
+        @param pose: [x, y, theta] of the vehicle
+        @return: True if the frame should be texture mapped, the skipped frames are counted
+        """
+        if self.start_timestamp is None:
+            self.start_timestamp = timestamp
+
+        keyframe = self.has_moved(pose) and self.within_budget(timestamp)
+        if not keyframe:
+            self.n_skipped += 1
+        return keyframe
+
+    def has_moved(self, pose):
+        if self.last_pose is None or (self.min_distance <= 0 and self.min_rotation <= 0):
+            return True
+        distance = np.hypot(pose[0] - self.last_pose[0], pose[1] - self.last_pose[1])
+        rotation = np.abs(np.arctan2(np.sin(pose[2] - self.last_pose[2]), np.cos(pose[2] - self.last_pose[2])))
+        return (0 < self.min_distance <= distance) or (0 < self.min_rotation <= rotation)
+
+    def within_budget(self, timestamp):
+        if self.compute_budget is None:
+            return True
+        return self.compute_time <= self.compute_budget * (timestamp - self.start_timestamp) * TIMESTAMP_UNIT
+
+    def state(self):
+        """
+        @return: Dict of the arrays of the policy for a checkpoint
+        """
+        return {
+            'keyframe_last_pose': np.full(3, np.nan) if self.last_pose is None else self.last_pose,
+            'keyframe_start_timestamp': np.array(-1 if self.start_timestamp is None else self.start_timestamp, dtype=np.int64),
+            'keyframe_counters': np.array([self.compute_time, self.n_keyframes, self.n_skipped]),
+        }
+
+    def restore(self, state):
+        self.last_pose = None if np.isnan(state['keyframe_last_pose']).any() else state['keyframe_last_pose'].copy()
+        self.start_timestamp = None if state['keyframe_start_timestamp'] < 0 else int(state['keyframe_start_timestamp'])
+        self.compute_time, n_keyframes, n_skipped = state['keyframe_counters']
+        self.n_keyframes, self.n_skipped = int(n_keyframes), int(n_skipped)
+
+    def add_keyframe(self, pose, compute_time):
+        """
+        @param pose: [x, y, theta] of the vehicle at the keyframe
+        @param compute_time: Seconds spent texture mapping it
+        """
+        self.last_pose = np.array(pose, dtype=np.float64)
+        self.compute_time += compute_time
+        self.n_keyframes += 1
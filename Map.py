@@ -1,16 +1,48 @@
 import cv2
 import matplotlib.pyplot as plt
+from numpy.lib.stride_tricks import sliding_window_view
 
 from Sensors.sensor_utils import *
+from TiledGrid import TiledGrid
+from checkpoint import grid_state, restore_grid
 
 MAP_SIZE = 1000
 
 LAMBDA_MIN = -6
 LAMBDA_MAX = 6
+LOG_ODDS_STEP = np.log(4)
+
+# Fixed-point scale of the log-odds, per storage dtype
+ODDS_SCALES = {
+    'float64': 1.0,
+    'int16': 2048.0,
+    'int8': 16.0,
+}
+
+# Number of poses correlated together, bounds the size of the (poses x beams) temporaries
+CORRELATION_BLOCK = 2048
+
+# Scan matching searches a (2 * radius + 1)^2 grid of cell offsets for every yaw offset
+SCAN_MATCH_RADIUS = 4
+SCAN_MATCH_YAWS = np.linspace(-0.02, 0.02, 5)
+SCAN_MATCH_BLOCK = 64
+
+# The likelihood field of a beam end point is exp(-d^2 / 2 sigma^2), with d the distance in cells to the closest occupied cell,
+# and d saturates at LIKELIHOOD_MAX_DISTANCE so only the cells that close to a change of the map need to be refreshed
+LIKELIHOOD_SIGMA = 1.0
+LIKELIHOOD_MAX_DISTANCE = 4
 
 
 class Map:
-    def __init__(self, x_min=-MAP_SIZE, y_min=-MAP_SIZE - 1000, x_max=MAP_SIZE + 1000, y_max=MAP_SIZE):
+    def __init__(self, x_min=-MAP_SIZE, y_min=-MAP_SIZE - 1000, x_max=MAP_SIZE + 1000, y_max=MAP_SIZE, tiled=False, odds_dtype='float64',
+                 pyramid_levels=0, likelihood_field=False):
+        """
+        @param tiled: Store the grids as lazily allocated tiles that grow without bounds, instead of dense arrays covering the bounds
+        @param odds_dtype: Storage of the log-odds, 'float64' or the fixed-point 'int16' and 'int8', see ODDS_SCALES
+        @param pyramid_levels: Number of max-pooled coarse levels of self.map, and of the likelihood field if any, kept for coarse-to-fine correlation
+        @param likelihood_field: Keep the likelihood field of self.map for the 'likelihood' observation model
+        """
+        self.tiled = tiled
         self.x_min = x_min
         self.y_min = y_min
         self.x_max = x_max
@@ -18,46 +50,130 @@ class Map:
         self.res = 4
         self.x_size = int(np.ceil((x_max - x_min) / self.res + 1))  # cells
         self.y_size = int(np.ceil((y_max - y_min) / self.res + 1))  # cells
-        self.odds = np.zeros((self.x_size, self.y_size))
-        self.map = np.ones((self.x_size, self.y_size), dtype="uint8")
+
+        # Log-odds are stored as odds_scale * log-odds and saturate at the scaled LAMBDA_MIN and LAMBDA_MAX
+        self.odds_scale = ODDS_SCALES[odds_dtype]
+        self.odds_step = LOG_ODDS_STEP * self.odds_scale
+        self.odds_min, self.odds_max = LAMBDA_MIN * self.odds_scale, LAMBDA_MAX * self.odds_scale
+
+        # Lookup table of the occupancy image for the fixed-point log-odds, indexed by odds - odds_min
+        self.probability_lut = None
+        if odds_dtype != 'float64':
+            self.odds_step = int(round(self.odds_step))
+            self.odds_min, self.odds_max = int(self.odds_min), int(self.odds_max)
+            lut_odds = np.arange(self.odds_min, self.odds_max + 1) / self.odds_scale
+            self.probability_lut = ((1 / (1 + np.exp(-lut_odds))) * 255).astype(np.uint8)
+
+        # The map used for correlation, 1 for the occupied cells, and the uint8 occupancy image are derived from the log-odds on every update
+        if self.tiled:
+            self.odds = TiledGrid(0, dtype=odds_dtype)
+            self.map = TiledGrid(0, dtype="uint8")
+            self.probability = TiledGrid(127, dtype="uint8")
+        else:
+            self.odds = np.zeros((self.x_size, self.y_size), dtype=odds_dtype)
+            self.map = np.zeros((self.x_size, self.y_size), dtype="uint8")
+            self.probability = np.full((self.x_size, self.y_size), 127, dtype="uint8")
+
+        # Level l of the pyramid holds the max of the 2^l x 2^l cells of self.map under each of its cells, i.e. whether any is occupied
+        self.pyramid = []
+        for level in range(1, pyramid_levels + 1):
+            if self.tiled:
+                self.pyramid.append(TiledGrid(0, dtype="uint8"))
+            else:
+                self.pyramid.append(np.zeros((-(-self.x_size >> level), -(-self.y_size >> level)), dtype="uint8"))
+
+        # Bounding box of the cells changed since each watcher last took it, and the grid it watches, 'map' or 'texture_map'
+        self.dirty_boxes = {}
+        self.watched_grids = {}
+
+        # The likelihood field is refreshed lazily, only over the bounding box of the cells of self.map changed since the last refresh
+        self.likelihood = None
+        self.likelihood_pyramid = []
+        if likelihood_field:
+            self.watch('likelihood', 'map')
+            likelihood_floor = np.exp(-0.5 * (LIKELIHOOD_MAX_DISTANCE / LIKELIHOOD_SIGMA) ** 2)
+            if self.tiled:
+                self.likelihood = TiledGrid(likelihood_floor, dtype="float32")
+            else:
+                self.likelihood = np.full((self.x_size, self.y_size), likelihood_floor, dtype="float32")
+
+            # Max-pooled levels of the likelihood field, refreshed along with it
+            for level in range(1, pyramid_levels + 1):
+                if self.tiled:
+                    self.likelihood_pyramid.append(TiledGrid(likelihood_floor, dtype="float32"))
+                else:
+                    self.likelihood_pyramid.append(np.full((-(-self.x_size >> level), -(-self.y_size >> level)), likelihood_floor, dtype="float32"))
         self.robot_coord = []
         self.texture_map = None
 
     def update_free(self, in_start_point, in_end_points):
         """
         Use breshanm to find the free and occupied pixels in the grid map.
+        The free and occupied increments are accumulated in a single pass over the cells of the scan, see accumulate_odds,
+        and only the cells whose log-odds changed are passed on to update_map, which derives the other grids and the dirty boxes from them.
         @param in_start_point: Robot position in world frame
         @param in_end_points: Lidar data in world frame
-        @return:
+        @return: Number of free cells updated
         """
         end_points = self.convert_to_map(in_end_points)
         start_point = self.convert_to_map(in_start_point[np.newaxis, :])[0, :]
 
         # Storing the location to draw the trajectory
         self.robot_coord.append(start_point)
+        if end_points.shape[0] == 0:
+            return 0
+
+        # Trace the lines of the scans, the cells crossed by several beams are not deduplicated
+        free_xs, free_ys = trace_free(start_point, end_points)
+        ind_good = self.in_bounds(free_xs, free_ys)
+        free_xs, free_ys = free_xs[ind_good], free_ys[ind_good]
+
+        occupied_xs, occupied_ys = end_points[:, 0], end_points[:, 1]
+        ind_good = self.in_bounds(occupied_xs, occupied_ys)
+        occupied_xs, occupied_ys = occupied_xs[ind_good], occupied_ys[ind_good]
+
+        xs, ys, n_free = self.accumulate_odds(free_xs, free_ys, occupied_xs, occupied_ys)
+        self.update_map(xs, ys)
+        return n_free
+
+    def accumulate_odds(self, free_xs, free_ys, occupied_xs, occupied_ys):
+        """
+        Adds odds_step to the log-odds of the free cells and subtracts it from the occupied ones, once per cell however many beams
+        hit it, and saturates the sum once. The cells are counted with a bincount over the bounding box of the scan, so no sort is needed.
+        @param free_xs: x-coordinates of the free cells, with duplicates
+        @param free_ys: y-coordinates of the free cells, with duplicates
+        @param occupied_xs: x-coordinates of the occupied cells, with duplicates
+        @param occupied_ys: y-coordinates of the occupied cells, with duplicates
+        @return: x and y coordinates of the cells whose log-odds changed, and the number of distinct free cells
+        """
+        xs = np.concatenate((free_xs, occupied_xs)).astype(np.intp)
+        ys = np.concatenate((free_ys, occupied_ys)).astype(np.intp)
+        if xs.shape[0] == 0:
+            return xs, ys, 0
+
+        # Linear index of every cell in the bounding box of the scan
+        x0, y0 = xs.min(), ys.min()
+        height = ys.max() - y0 + 1
+        size = (xs.max() - x0 + 1) * height
+        index = (xs - x0) * height + (ys - y0)
+        n_free_cells = free_xs.shape[0]
+        free = np.bincount(index[:n_free_cells], minlength=size) > 0
+        occupied = np.bincount(index[n_free_cells:], minlength=size) > 0
 
-        # Trace the lines of the scans
-        free_pixels = get_mapping(start_point, end_points)
-        if free_pixels is not None:
-            xis, yis = free_pixels[:, 0], free_pixels[:, 1]
-            ind_good = np.logical_and(np.logical_and(np.logical_and((xis > 1), (yis > 1)), (xis < self.x_size)), (yis < self.y_size))
-
-            # Update the log odds for free
-            added_logs = self.odds[xis[ind_good], yis[ind_good]] + np.log(4)
-            clipped_vals = np.clip(added_logs, LAMBDA_MIN, LAMBDA_MAX)
-            self.odds[xis[ind_good], yis[ind_good]] = clipped_vals
-
-            # Faster way to update the map
-            self.update_map(xis[ind_good], yis[ind_good])
-
-        if end_points is not None:
-            # Update the log odds for Occupied
-            xis, yis = end_points[:, 0], end_points[:, 1]
-            ind_good = np.logical_and(np.logical_and(np.logical_and((xis > 1), (yis > 1)), (xis < self.x_size)), (yis < self.y_size))
-            added_logs = self.odds[xis[ind_good], yis[ind_good]] - np.log(4)
-            clipped_vals = np.clip(added_logs, LAMBDA_MIN, LAMBDA_MAX)
-            self.odds[xis[ind_good], yis[ind_good]] = clipped_vals
-            self.update_map(xis[ind_good], yis[ind_good])
+        cells = np.flatnonzero(free | occupied)
+        step = free[cells].astype(np.int32) - occupied[cells]
+        xs, ys = cells // height + x0, cells % height + y0
+
+        odds = self.odds[xs, ys]
+        if odds.dtype.kind == 'i':
+            odds = odds.astype(np.int32)
+        new_odds = np.clip(odds + step * self.odds_step, self.odds_min, self.odds_max)
+
+        # Saturated cells do not change, and are left out of the derived grids
+        changed = new_odds != odds
+        xs, ys = xs[changed], ys[changed]
+        self.odds[xs, ys] = new_odds[changed]
+        return xs, ys, int(np.count_nonzero(free))
 
     def update_map(self, xs, ys):
         """
@@ -66,9 +182,105 @@ class Map:
         @param ys: y-coordinates to be updated
         @return:
         """
-        # self.map = np.where(self.odds.T < 0, 1, 0)
-        self.map[xs, ys] = np.where(self.odds[xs, ys] < 0, 0, 1)
-        pass
+        odds = self.odds[xs, ys]
+        self.map[xs, ys] = odds < 0
+        if self.probability_lut is not None:
+            self.probability[xs, ys] = self.probability_lut[odds.astype(np.int32) - self.odds_min]
+        else:
+            self.probability[xs, ys] = ((1 / (1 + np.exp(-odds))) * 255).astype(np.uint8)
+        self.update_pyramid(xs, ys, self.map, self.pyramid)
+        self.mark_dirty('map', xs, ys)
+
+    def watch(self, name, grid):
+        """
+        Starts tracking the bounding box of the cells of a grid that change
+        @param name: Name of the watcher, see take_dirty
+        @param grid: 'map' for the occupancy grids, 'texture_map' for the texture
+        """
+        self.dirty_boxes[name] = None
+        self.watched_grids[name] = grid
+
+    def mark_dirty(self, grid, xs, ys):
+        if xs.shape[0] == 0:
+            return
+        box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        for name, watched in self.watched_grids.items():
+            if watched != grid:
+                continue
+            dirty = self.dirty_boxes[name]
+            if dirty is not None:
+                dirty = (min(box[0], dirty[0]), min(box[1], dirty[1]), max(box[2], dirty[2]), max(box[3], dirty[3]))
+            self.dirty_boxes[name] = box if dirty is None else dirty
+
+    def take_dirty(self, name):
+        """
+        @param name: Name of the watcher
+        @return: (x0, y0, x1, y1) bounding box of the cells changed since the last call, None if none changed
+        """
+        box = self.dirty_boxes[name]
+        self.dirty_boxes[name] = None
+        return box
+
+    def likelihood_field(self):
+        """
+        Refreshes the dirty region of the likelihood field with a distance transform of the cells of self.map that are not occupied.
+        Only the cells within LIKELIHOOD_MAX_DISTANCE of a change can change, and their distance only depends on the cells within
+        LIKELIHOOD_MAX_DISTANCE of them, so the transform runs on the dirty box grown twice by that distance. The refreshed cells are
+        max-pooled into the levels of the likelihood pyramid.
+        @return: The likelihood field, indexed like self.map
+        """
+        dirty = self.take_dirty('likelihood')
+        if dirty is None:
+            return self.likelihood
+
+        margin = LIKELIHOOD_MAX_DISTANCE
+        x0, y0, x1, y1 = dirty
+        x0, y0, x1, y1 = x0 - margin, y0 - margin, x1 + margin, y1 + margin
+        if not self.tiled:
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, self.x_size), min(y1, self.y_size)
+
+        # Cells out of bounds are free, so they do not pull the field
+        source = 1 - self.crop(self.map, x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+        distance = cv2.distanceTransform(source, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[margin:-margin, margin:-margin]
+        likelihood = np.exp(-0.5 * (np.minimum(distance, LIKELIHOOD_MAX_DISTANCE) / LIKELIHOOD_SIGMA) ** 2)
+        if self.tiled:
+            self.likelihood.paste(x0, y0, likelihood)
+        else:
+            self.likelihood[x0:x1, y0:y1] = likelihood
+        if self.likelihood_pyramid:
+            xs, ys = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1), indexing='ij')
+            self.update_pyramid(xs.ravel(), ys.ravel(), self.likelihood, self.likelihood_pyramid)
+        return self.likelihood
+
+    def observation_grid(self, model, level=0):
+        """
+        @param model: 'hits' counts the beams ending in occupied cells of self.map, 'likelihood' sums the likelihood field at the beam end points
+        @param level: Level of the pyramid of the model, 0 is the full resolution grid
+        @return: Grid gathered at the beam end points
+        """
+        if model == 'likelihood':
+            likelihood = self.likelihood_field()
+            return likelihood if level == 0 else self.likelihood_pyramid[level - 1]
+        return self.map if level == 0 else self.pyramid[level - 1]
+
+    def update_pyramid(self, xs, ys, grid, pyramid):
+        """
+        Max-pools the updated cells of a grid into every level of its pyramid
+        @param xs: x-coordinates updated in grid
+        @param ys: y-coordinates updated in grid
+        @param grid: self.map or self.likelihood
+        @param pyramid: Levels of the grid, self.pyramid or self.likelihood_pyramid
+        @return:
+        """
+        below = grid
+        for level in pyramid:
+            xs, ys = xs >> 1, ys >> 1
+            x0, y0 = xs << 1, ys << 1
+            x1, y1 = x0 + 1, y0 + 1
+            if not self.tiled:
+                x1, y1 = np.minimum(x1, below.shape[0] - 1), np.minimum(y1, below.shape[1] - 1)
+            level[xs, ys] = np.maximum(np.maximum(below[x0, y0], below[x1, y0]), np.maximum(below[x0, y1], below[x1, y1]))
+            below = level
 
     def update_robot_pose(self, robot_position):
         robot_coord = self.convert_to_map(robot_position[np.newaxis, :])[0, :]
@@ -76,23 +288,221 @@ class Map:
         # Storing the location to draw the trajectory
         self.robot_coord.append(robot_coord)
 
-    def map_correlation(self, in_end_points):
+    def map_correlation_batch(self, poses, in_end_points, level=0, model='hits'):
         """
-        Correlates a set of points with the current map
-        @param in_end_points: list of [x,y]
-        @return: Correlation Value
+        Correlates a single scan with the current map for many poses at once
+        @param poses: (P, 3) array of [x, y, theta] in world frame
+        @param in_end_points: (N, 2) Lidar end points in the robot frame
+        @param level: Level of the pyramid to correlate with, 0 is self.map
+        @param model: Observation model, see observation_grid
+        @return: (P,) Correlation Values
         """
-        end_points = self.convert_to_map(in_end_points)
-        xis, yis = end_points[:, 0].astype(np.int16), end_points[:, 1].astype(np.int16)
-        ind_good = np.logical_and(np.logical_and(np.logical_and((xis > 1), (yis > 1)), (xis < self.x_size)), (yis < self.y_size))
-        val = np.sum(self.map[xis[ind_good], yis[ind_good]])
-        return val
+        grid = self.observation_grid(model, level)
+        values = np.zeros(poses.shape[0], dtype=np.result_type(grid.dtype, np.int64))
+        for start in range(0, poses.shape[0], CORRELATION_BLOCK):
+            block = poses[start:start + CORRELATION_BLOCK]
+            cos = np.cos(block[:, 2])[:, np.newaxis]
+            sin = np.sin(block[:, 2])[:, np.newaxis]
+
+            # Transform the scan to the world frame of every pose and then to grid cells
+            xs = in_end_points[:, 0] * cos - in_end_points[:, 1] * sin + block[:, 0:1]
+            ys = in_end_points[:, 0] * sin + in_end_points[:, 1] * cos + block[:, 1:2]
+            xis = np.ceil((xs - self.x_min) / self.res).astype(np.intp) - 1
+            yis = np.ceil((ys - self.y_min) / self.res).astype(np.intp) - 1
+
+            # Cells outside the map are gathered from (0, 0) and masked out of the sum
+            ind_good = self.in_bounds(xis, yis)
+            hits = grid[np.where(ind_good, xis, 0) >> level, np.where(ind_good, yis, 0) >> level]
+            values[start:start + CORRELATION_BLOCK] = np.sum(hits * ind_good, axis=1)
+        return values
+
+    def map_correlation_coarse_to_fine(self, poses, in_end_points, level, top_k, model='hits'):
+        """
+        Scores all the poses with every 2^level-th beam on a coarse level of the pyramid, and refines only the top_k of them with all the beams at full resolution.
+        Both passes use the same observation model, the coarse one on its max-pooled grid, so the scores are in the same units.
+        The other poses keep their coarse score, capped to the lowest refined one so they never rank above a refined pose.
+        @param poses: (P, 3) array of [x, y, theta] in world frame
+        @param in_end_points: (N, 2) Lidar end points in the robot frame
+        @param level: Level of the pyramid of the coarse pass
+        @param top_k: Number of poses refined at full resolution
+        @param model: Observation model, see observation_grid
+        @return: (P,) Correlation Values
+        """
+        if top_k >= poses.shape[0]:
+            return self.map_correlation_batch(poses, in_end_points, model=model)
+
+        step = 1 << level
+        coarse = self.map_correlation_batch(poses, in_end_points[::step], level, model=model) * step
+        top = np.argpartition(coarse, -top_k)[-top_k:]
+        fine = self.map_correlation_batch(poses[top], in_end_points, model=model)
+
+        values = np.minimum(coarse, np.min(fine)).astype(fine.dtype)
+        values[top] = fine
+        return values
+
+    def scan_match(self, poses, in_end_points, radius=SCAN_MATCH_RADIUS, yaw_offsets=SCAN_MATCH_YAWS, model='hits'):
+        """
+        Searches a grid of x/y cell offsets and yaw offsets around every pose for the best correlation with the map.
+        The scan is rotated once per yaw offset, and rasterised for every pose into a template counting the beams ending in each cell.
+        The scores of all the x/y offsets are then a single correlation of the templates with the window of the map around the pose,
+        computed as one matrix product, instead of reading the neighbourhood of every beam.
+        Ties go to the smallest offset, so a pose only moves on a strict improvement and stays put on a flat score surface.
+        @param poses: (P, 3) array of [x, y, theta] in world frame
+        @param in_end_points: (N, 2) Lidar end points in the robot frame
+        @param radius: The x/y search covers [-radius, radius] cells
+        @param yaw_offsets: (K,) yaw offsets in radians
+        @param model: Observation model, see observation_grid
+        @return: (P, 3) best poses and (P,) their Correlation Values
+        """
+        width = 2 * radius + 1
+        grid = self.observation_grid(model)
+        score_dtype = np.result_type(grid.dtype, np.int64)
+
+        # The beam counts are exact in float32, so only the likelihood field needs float64
+        work_dtype = np.float32 if grid.dtype.kind in 'ui' else np.float64
+
+        # Rotated scan templates, one per yaw offset
+        yaw_offsets = np.asarray(yaw_offsets)
+        n_yaws = yaw_offsets.shape[0]
+        cos = np.cos(yaw_offsets)[:, np.newaxis]
+        sin = np.sin(yaw_offsets)[:, np.newaxis]
+        template_x = in_end_points[:, 0] * cos - in_end_points[:, 1] * sin
+        template_y = in_end_points[:, 0] * sin + in_end_points[:, 1] * cos
+
+        # Candidates ordered by the size of their cell offset, then of their yaw offset, the zero offset first
+        k, i, j = np.unravel_index(np.arange(n_yaws * width * width), (n_yaws, width, width))
+        order = np.lexsort((np.abs(yaw_offsets[k]), (i - radius) ** 2 + (j - radius) ** 2))
+
+        best_poses = np.array(poses, dtype=np.float64)
+        values = np.zeros(poses.shape[0], dtype=score_dtype)
+        for start in range(0, poses.shape[0], SCAN_MATCH_BLOCK):
+            block = poses[start:start + SCAN_MATCH_BLOCK]
+            n_poses = block.shape[0]
+            cos = np.cos(block[:, 2])[:, np.newaxis, np.newaxis]
+            sin = np.sin(block[:, 2])[:, np.newaxis, np.newaxis]
+            xs = template_x * cos - template_y * sin + block[:, 0, np.newaxis, np.newaxis]
+            ys = template_x * sin + template_y * cos + block[:, 1, np.newaxis, np.newaxis]
+            xis = np.ceil((xs - self.x_min) / self.res).astype(np.intp) - 1
+            yis = np.ceil((ys - self.y_min) / self.res).astype(np.intp) - 1
+
+            # (size x size) template of every pose and yaw offset, relative to the lowest cell of the pose
+            origin_x, origin_y = xis.min(axis=(1, 2)), yis.min(axis=(1, 2))
+            xis -= origin_x[:, np.newaxis, np.newaxis]
+            yis -= origin_y[:, np.newaxis, np.newaxis]
+            size = max(xis.max(), yis.max()) + 1
+            cells = ((np.arange(n_poses)[:, np.newaxis, np.newaxis] * n_yaws + np.arange(n_yaws)[:, np.newaxis]) * size + xis) * size + yis
+            templates = np.bincount(cells.ravel(), minlength=n_poses * n_yaws * size * size).astype(work_dtype)
+            templates = templates.reshape(n_poses, n_yaws, size * size)
+
+            # Window of the map around every pose, and the (size x size) patch under the template for every x/y offset
+            x0, y0 = origin_x.min() - radius, origin_y.min() - radius
+            region = self.crop(grid, x0, y0, origin_x.max() + size + radius, origin_y.max() + size + radius).astype(work_dtype)
+            windows = sliding_window_view(region, (size + width - 1, size + width - 1))[origin_x - radius - x0, origin_y - radius - y0]
+            patches = sliding_window_view(windows, (size, size), axis=(1, 2)).reshape(n_poses, width * width, size * size)
+            scores = np.matmul(templates, patches.transpose(0, 2, 1)).reshape(n_poses, -1)
+
+            # Snap every pose to its best offset, the first of the tied best ones in order
+            best = order[np.argmax(scores[:, order], axis=1)]
+            k, i, j = np.unravel_index(best, (n_yaws, width, width))
+            best_poses[start:start + SCAN_MATCH_BLOCK, 0] += (i - radius) * self.res
+            best_poses[start:start + SCAN_MATCH_BLOCK, 1] += (j - radius) * self.res
+            best_poses[start:start + SCAN_MATCH_BLOCK, 2] += yaw_offsets[k]
+            values[start:start + SCAN_MATCH_BLOCK] = scores[np.arange(n_poses), best]
+        return best_poses, values
+
+    def new_texture_map(self):
+        if self.tiled:
+            return TiledGrid(0, dtype="uint8", channels=3)
+        return np.zeros((self.x_size, self.y_size, 3), dtype="uint8") * 255
 
     def build_texture(self, coord, pixel_values):
         if self.texture_map is None:
-            self.texture_map = np.zeros((self.x_size, self.y_size, 3), dtype="uint8") * 255
+            self.texture_map = self.new_texture_map()
         new_coord = self.convert_to_map(coord)
-        self.texture_map[new_coord[:, 0], new_coord[:, 1]] = pixel_values
+        ind_good = self.in_bounds(new_coord[:, 0], new_coord[:, 1])
+        self.texture_map[new_coord[ind_good, 0], new_coord[ind_good, 1]] = pixel_values[ind_good]
+        self.mark_dirty('texture_map', new_coord[ind_good, 0], new_coord[ind_good, 1])
+
+    def state(self):
+        """
+        @return: Dict of the arrays of the map for a checkpoint, the likelihood field is rebuilt from self.map when restored
+        """
+        state = {}
+        state.update(grid_state('odds', self.odds))
+        state.update(grid_state('map', self.map))
+        state.update(grid_state('probability', self.probability))
+        for level, grid in enumerate(self.pyramid, 1):
+            state.update(grid_state('pyramid_' + str(level), grid))
+        if self.texture_map is not None:
+            state.update(grid_state('texture_map', self.texture_map))
+        state['robot_coord'] = np.array(self.robot_coord, dtype=np.int64).reshape(-1, 2)
+        return state
+
+    def restore(self, state):
+        """
+        Restores the map from a checkpoint. The dense grids are written in place, so the grids shared with other processes stay shared.
+        @param state: Dict of the arrays of the checkpoint
+        """
+        restore_grid('odds', state, self.odds)
+        restore_grid('map', state, self.map)
+        restore_grid('probability', state, self.probability)
+        for level, grid in enumerate(self.pyramid, 1):
+            restore_grid('pyramid_' + str(level), state, grid)
+        self.texture_map = None
+        if 'texture_map' in state or 'texture_map/keys' in state:
+            self.texture_map = self.new_texture_map()
+            restore_grid('texture_map', state, self.texture_map)
+        self.robot_coord = list(state['robot_coord'])
+
+        # Everything changed for the watchers, e.g. the likelihood field is refreshed over the whole map
+        for name, grid in self.watched_grids.items():
+            grid = getattr(self, grid)
+            self.dirty_boxes[name] = None if grid is None else self.grid_bounds(grid)
+
+    def in_bounds(self, xis, yis):
+        """
+        @param xis: x-coordinates of cells
+        @param yis: y-coordinates of cells
+        @return: Mask of the cells that can be read and written, a tiled map has no bounds
+        """
+        if self.tiled:
+            return np.ones(np.shape(xis), dtype=bool)
+        return (xis > 1) & (yis > 1) & (xis < self.x_size) & (yis < self.y_size)
+
+    def crop(self, grid, x0, y0, x1, y1, fill_value=0):
+        """
+        Dense copy of the cells [x0, x1) x [y0, y1) of a grid of the map. Cells out of bounds read as fill_value.
+        @param grid: One of the grids of the map, e.g. self.map
+        @param fill_value: Value of the cells out of bounds, a tiled grid has no bounds and reads its own fill value
+        @return: (x1 - x0, y1 - y0) array
+        """
+        if self.tiled:
+            return grid.crop(x0, y0, x1, y1)
+        out = np.full((x1 - x0, y1 - y0) + grid.shape[2:], fill_value, dtype=grid.dtype)
+        cx0, cy0 = max(x0, 2), max(y0, 2)
+        cx1, cy1 = min(x1, self.x_size), min(y1, self.y_size)
+        if cx0 < cx1 and cy0 < cy1:
+            out[cx0 - x0:cx1 - x0, cy0 - y0:cy1 - y0] = grid[cx0:cx1, cy0:cy1]
+        return out
+
+    def grid_bounds(self, grid):
+        """
+        @param grid: One of the grids of the map, e.g. self.probability
+        @return: (x0, y0, x1, y1) of the cells of the grid, for a tiled map it covers the allocated tiles
+        """
+        if self.tiled:
+            bounds = grid.bounds()
+            return bounds if bounds is not None else (0, 0, 1, 1)
+        return 0, 0, grid.shape[0], grid.shape[1]
+
+    def dense(self, grid):
+        """
+        @param grid: One of the grids of the map, e.g. self.odds
+        @return: Dense array of the grid, for a tiled map it covers the allocated tiles
+        """
+        if self.tiled:
+            return grid.to_dense()[0]
+        return grid
 
     def convert_to_map(self, points):
         """
@@ -101,12 +511,12 @@ class Map:
         @return:
         """
         new_points = np.zeros_like(points)
-        new_points[:, 0] = np.ceil((points[:, 0] - self.x_min) / self.res).astype(np.int16) - 1
-        new_points[:, 1] = np.ceil((points[:, 1] - self.y_min) / self.res).astype(np.int16) - 1
+        new_points[:, 0] = np.ceil((points[:, 0] - self.x_min) / self.res).astype(np.int64) - 1
+        new_points[:, 1] = np.ceil((points[:, 1] - self.y_min) / self.res).astype(np.int64) - 1
         return new_points.astype(int)
 
     def display_map(self, wait_key=10):
-        img = ((1 / (1 + np.exp(-self.odds))) * 255).astype(np.uint8)
+        img = self.dense(self.probability)
         name = "Occupancy Map"
         cv2.imshow(name, img)
         cv2.waitKey(wait_key)
@@ -118,7 +528,7 @@ class Map:
         @return:
         """
         if self.texture_map is not None:
-            img = self.texture_map
+            img = self.dense(self.texture_map)
             name = "Texture Map"
             cv2.imshow(name, img)
             cv2.waitKey(0)
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Additive noise on [x, y, theta] after every prediction
+MOTION_SIGMAS = [0.5, 0.5, 0.01]
+
+
+class MotionModel:
+    def __init__(self, n_particles, sigmas=MOTION_SIGMAS, alphas=None, rng=None):
+        """
+        Vectorised differential-drive motion model, it moves all the particles at once and writes into preallocated buffers.
+
+        @param n_particles: Number of poses moved on every prediction
+        @param sigmas: Standard deviations of the additive [x, y, theta] noise
+        @param alphas: Optional [a1, a2, a3, a4] of the differential-drive noise. The distance gets a noise of std a1 * |distance| + a2 * |d_theta|
+                       and the rotation a noise of std a3 * |d_theta| + a4 * |distance|
+        @param rng: np.random.Generator used for all the noise, a new unseeded one if None
+        """
+        self.n_particles = n_particles
+        self.sigmas = np.asarray(sigmas, dtype=np.float64)
+        self.alphas = None if alphas is None else np.asarray(alphas, dtype=np.float64)
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.distance = np.empty(n_particles)
+        self.rotation = np.empty(n_particles)
+        self.step = np.empty(n_particles)
+        self.drive_noise = np.empty((n_particles, 2))
+        self.noise = np.empty((n_particles, 3))
+
+    def predict(self, poses, delta_robot_pose, n_noisy=None):
+        """
+        Moves the poses in place with the odometry and adds noise to the first n_noisy of them.
+
+        @param poses: (n_particles, 3) array of [x, y, theta]
+        @param delta_robot_pose: [distance, d_theta]
+        @param n_noisy: Number of leading poses that get noise, all of them if None
+        @return:
+        """
+        n_noisy = self.n_particles if n_noisy is None else n_noisy
+        distance, rotation = self.distance, self.rotation
+        distance.fill(delta_robot_pose[0])
+        rotation.fill(delta_robot_pose[1])
+
+        # Differential-drive noise proportional to the distance and rotation
+        if self.alphas is not None and n_noisy > 0:
+            abs_distance, abs_rotation = abs(delta_robot_pose[0]), abs(delta_robot_pose[1])
+            noise = self.drive_noise[:n_noisy]
+            self.rng.standard_normal(out=noise)
+            distance[:n_noisy] += noise[:, 0] * (self.alphas[0] * abs_distance + self.alphas[1] * abs_rotation)
+            rotation[:n_noisy] += noise[:, 1] * (self.alphas[2] * abs_rotation + self.alphas[3] * abs_distance)
+
+        np.cos(poses[:, 2], out=self.step)
+        self.step *= distance
+        poses[:, 0] += self.step
+        np.sin(poses[:, 2], out=self.step)
+        self.step *= distance
+        poses[:, 1] += self.step
+        poses[:, 2] += rotation
+
+        # Additive noise
+        if n_noisy > 0:
+            noise = self.noise[:n_noisy]
+            self.rng.standard_normal(out=noise)
+            noise *= self.sigmas
+            poses[:n_noisy] += noise
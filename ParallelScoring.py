@@ -0,0 +1,175 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+from Map import *
+
+PARALLEL_MODES = ['thread', 'process']
+
+# Number of beams the shared scan buffer holds, it is reallocated for larger scans
+SCAN_CAPACITY = 2048
+
+# Map and buffers of a process worker, attached once by _init_worker
+_worker = {}
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(map_bounds, map_buffers, buffers):
+    """
+    Attaches a process worker to the shared map and buffers. The worker map has the geometry of the filter map and its grids are
+    views of the shared memory, so the updates of the filter are seen without copying anything. The worker map never changes by
+    itself, so its likelihood field is the shared one, refreshed by the filter before the workers score.
+    @param map_bounds: (x_min, y_min, x_max, y_max) of the map
+    @param map_buffers: Dict of map attribute -> (shared memory name, shape, dtype)
+    @param buffers: Dict of buffer name -> (shared memory name, shape, dtype)
+    """
+    grid_map = Map(*map_bounds, likelihood_field='likelihood' in map_buffers)
+    _worker['shm'] = []
+    for attribute, spec in map_buffers.items():
+        shm, array = _attach(*spec)
+        setattr(grid_map, attribute, array)
+        _worker['shm'].append(shm)
+    for name, spec in buffers.items():
+        shm, _worker[name] = _attach(*spec)
+        _worker['shm'].append(shm)
+    _worker['map'] = grid_map
+
+
+def _score_chunk(method, start, end, n_beams, model):
+    """
+    Scores the particles [start, end) of the shared poses with the shared scan, the results are written to the shared outputs
+    """
+    grid_map = _worker['map']
+    poses, scan = _worker['poses'][start:end], _worker['scan'][:n_beams]
+    if method == 'scan_match':
+        best_poses, values = grid_map.scan_match(poses, scan, model=model)
+        _worker['best_poses'][start:end] = best_poses
+    else:
+        values = grid_map.map_correlation_batch(poses, scan, model=model)
+    _worker['values'][start:end] = values
+
+
+class ParallelScorer:
+    def __init__(self, grid_map, n_particles, n_workers, mode='thread'):
+        """
+        Splits the scoring of the particles across a pool of workers. It has the map_correlation_batch and scan_match methods of the map.
+        With 'thread', the workers share the map and run the NumPy kernels, which release the GIL.
+        With 'process', the grids of the map are moved to shared memory, along with the poses, the scan and the outputs, so nothing
+        is pickled per step. It needs a dense map.
+
+        @param grid_map: Map of the particle filter
+        @param n_particles: Number of particles
+        @param n_workers: Number of workers
+        @param mode: 'thread' or 'process'
+        """
+        if mode == 'process' and grid_map.tiled:
+            print("ERROR: A tiled map cannot be shared with processes, scoring with threads")
+            mode = 'thread'
+
+        self.map = grid_map
+        self.n_workers = n_workers
+        self.mode = mode
+        self.shared = {}
+        self.buffers = {}
+
+        if mode == 'thread':
+            self.pool = ThreadPoolExecutor(n_workers)
+            return
+
+        # The map keeps writing its grids in place, now in shared memory
+        self.map_attributes = ['map'] if grid_map.likelihood is None else ['map', 'likelihood']
+        for attribute in self.map_attributes:
+            setattr(grid_map, attribute, self._share(attribute, getattr(grid_map, attribute)))
+        self._share('poses', np.zeros((n_particles, 3)))
+        self._share('best_poses', np.zeros((n_particles, 3)))
+        self._share('values', np.zeros(n_particles))
+        self._share('scan', np.zeros((SCAN_CAPACITY, 2)))
+        self.pool = None
+        self._start_pool()
+
+    def _share(self, name, array):
+        """
+        Copies an array to a new shared memory block
+        @return: The array in shared memory
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[...] = array
+        self.shared[name] = shm
+        self.buffers[name] = shared
+        return shared
+
+    def _spec(self, name):
+        array = self.buffers[name]
+        return self.shared[name].name, array.shape, array.dtype
+
+    def _start_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        map_bounds = (self.map.x_min, self.map.y_min, self.map.x_max, self.map.y_max)
+        map_buffers = {attribute: self._spec(attribute) for attribute in self.map_attributes}
+        buffers = {name: self._spec(name) for name in ['poses', 'best_poses', 'values', 'scan']}
+        self.pool = ProcessPoolExecutor(self.n_workers, initializer=_init_worker, initargs=(map_bounds, map_buffers, buffers))
+
+    def _chunks(self, n):
+        bounds = np.linspace(0, n, self.n_workers + 1).astype(int)
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+    def _run(self, method, poses, in_end_points, model):
+        """
+        @return: (P,) values, and (P, 3) best poses for scan_match
+        """
+        # The likelihood field is refreshed once here, not by every worker
+        score_dtype = np.result_type(self.map.observation_grid(model).dtype, np.int64)
+
+        if self.mode == 'thread':
+            futures = [self.pool.submit(getattr(self.map, method), poses[start:end], in_end_points, model=model)
+                       for start, end in self._chunks(poses.shape[0])]
+            results = [future.result() for future in futures]
+            if method == 'scan_match':
+                return np.concatenate([r[1] for r in results]), np.concatenate([r[0] for r in results])
+            return np.concatenate(results), None
+
+        n_beams = in_end_points.shape[0]
+        if n_beams > self.buffers['scan'].shape[0]:
+            self.shared.pop('scan').unlink()
+            self._share('scan', np.zeros((n_beams, 2)))
+            self._start_pool()
+        self.buffers['poses'][:poses.shape[0]] = poses
+        self.buffers['scan'][:n_beams] = in_end_points
+
+        futures = [self.pool.submit(_score_chunk, method, start, end, n_beams, model) for start, end in self._chunks(poses.shape[0])]
+        for future in futures:
+            future.result()
+        values = self.buffers['values'][:poses.shape[0]].astype(score_dtype)
+        return values, self.buffers['best_poses'][:poses.shape[0]].copy()
+
+    def map_correlation_batch(self, poses, in_end_points, model='hits'):
+        """
+        Map.map_correlation_batch split across the workers
+        """
+        return self._run('map_correlation_batch', poses, in_end_points, model)[0]
+
+    def scan_match(self, poses, in_end_points, model='hits'):
+        """
+        Map.scan_match split across the workers
+        """
+        values, best_poses = self._run('scan_match', poses, in_end_points, model)
+        return best_poses, values
+
+    def close(self):
+        """
+        Stops the workers and moves the grids of the map back to private memory
+        """
+        self.pool.shutdown()
+        if self.mode == 'process':
+            for attribute in self.map_attributes:
+                setattr(self.map, attribute, np.array(getattr(self.map, attribute)))
+            self.buffers.clear()
+            for shm in self.shared.values():
+                shm.close()
+                shm.unlink()
+            self.shared.clear()
@@ -1,6 +1,11 @@
-from Map import *
+import json
 
-EPSILON = 1e-5
+from Instrumentation import Instruments
+from Map import *
+from MotionModel import *
+from ParallelScoring import ParallelScorer
+from ParticleSet import ParticleSet
+from resampling import RESAMPLERS, effective_sample_size
 
 
 def convert_to_world_frame(angle, pos, points):
@@ -9,34 +14,46 @@ def convert_to_world_frame(angle, pos, points):
     return points
 
 
-def add_noise(n, sigmas):
-    n = np.random.normal(np.zeros(len(sigmas)), sigmas, size=(n, len(sigmas)))
-    return n
-
-
-class Particle:
-    def __init__(self, position=[0, 0], angle=0, weight=0.0):
-        self.position = position
-        self.angle = angle
-        self.weight = weight
+def log_sum_exp(values):
+    max_value = np.max(values)
+    return max_value + np.log(np.sum(np.exp(values - max_value)))
 
 
 class ParticleFilter:
-    def __init__(self, n_particles=20, enable_dead_reckoning=False):
-        self.n_particles = n_particles
+    def __init__(self, n_particles=20, enable_dead_reckoning=False, enable_scan_matching=False, motion_sigmas=MOTION_SIGMAS, motion_alphas=None, seed=None,
+                 resampling='stratified', resample_threshold=0.5, temperature=1.0, tiled_map=False,
+                 map_odds_dtype='float64', coarse_level=0, refine_top_k=None, observation_model='hits',
+                 n_workers=1, parallel_mode='thread', instruments=None):
         self.enable_dead_reckoning = enable_dead_reckoning
+        self.enable_scan_matching = enable_scan_matching
+        self.resampler = RESAMPLERS[resampling]
+        self.resample_threshold = resample_threshold
+        self.temperature = temperature
+        self.coarse_level = coarse_level
+        self.observation_model = observation_model
+        self.rng = np.random.default_rng(seed)
+        self.instruments = instruments if instruments is not None else Instruments()
+
+        self.map = Map(tiled=tiled_map, odds_dtype=map_odds_dtype, pyramid_levels=coarse_level,
+                       likelihood_field=observation_model == 'likelihood')
+
+        # A single noise free particle is used for Dead-Reckoning
+        if self.enable_dead_reckoning:
+            n_particles = 1
+        self.n_particles = n_particles
+        self.particles = ParticleSet(n_particles)
+        self.weights = np.ones(n_particles) / n_particles
+        self.refine_top_k = refine_top_k if refine_top_k is not None else max(1, n_particles // 10)
 
-        self.map = Map()
+        # Statistics of the weights, refreshed on every update and resample
+        self.n_eff = float(n_particles)
+        self.weight_entropy = np.log(n_particles)
+        self.motion_model = MotionModel(n_particles, sigmas=motion_sigmas, alphas=motion_alphas, rng=self.rng)
 
-        # Let any particle be the best particle
-        self.best_particle = Particle()
-
-        # One Particle feature is used for Dead-Reckoning
-        if self.enable_dead_reckoning:
-            self.one_particle = Particle()
-        else:
-            self.particle_poses = np.zeros((n_particles, 3))
-            self.particle_weights = np.ones(n_particles) / n_particles
+        # The particles are scored by a pool of workers, or by the map itself
+        self.scorer = None
+        if n_workers > 1 and not self.enable_dead_reckoning:
+            self.scorer = ParallelScorer(self.map, n_particles, n_workers, mode=parallel_mode)
 
     def initialise_map(self, lidar_observation):
         """
@@ -46,31 +63,25 @@ class ParticleFilter:
 
         As name suggests it initialises the map with the first data from lidar sensor
         """
-        self.best_particle = Particle()
-        lidar_coord_world = convert_to_world_frame(self.best_particle.angle, self.best_particle.position, lidar_observation[:, :2])
-        self.map.update_free(np.array(self.best_particle.position), lidar_coord_world)
+        best_pose = self.particles.best_pose
+        lidar_coord_world = convert_to_world_frame(best_pose[2], best_pose[:2], lidar_observation[:, :2])
+        self.map.update_free(best_pose[:2], lidar_coord_world)
         return
 
     def predict(self, delta_robot_pose):
         """
         Update the pose using the delta pose and the current pose. Also, add noise to the particles.
 
-        @param delta_robot_pose: [dx, dy, d_theta]
+        @param delta_robot_pose: [distance, d_theta]
         @return:
         """
-        if self.enable_dead_reckoning:
-            self.one_particle.position[0] += delta_robot_pose[0] * np.cos(self.one_particle.angle)
-            self.one_particle.position[1] += delta_robot_pose[0] * np.sin(self.one_particle.angle)
-            self.one_particle.angle += delta_robot_pose[1]
-            self.map.update_robot_pose(np.array(self.one_particle.position))
-        else:
-            # Add noise to the particles
-            for i in range(self.particle_poses.shape[0]):
-                self.particle_poses[i, 0] += delta_robot_pose[0] * np.cos(self.particle_poses[i, 2])
-                self.particle_poses[i, 1] += delta_robot_pose[0] * np.sin(self.particle_poses[i, 2])
-                self.particle_poses[i, 2] += delta_robot_pose[1]
-
-            self.particle_poses[:-1] += add_noise(self.particle_poses.shape[0] - 1, [0.5, 0.5, 0.01])
+        with self.instruments.timer('predict'):
+            if self.enable_dead_reckoning:
+                self.motion_model.predict(self.particles.poses, delta_robot_pose, n_noisy=0)
+                self.map.update_robot_pose(self.particles.poses[0, :2])
+            else:
+                # The last particle is kept noise free
+                self.motion_model.predict(self.particles.poses, delta_robot_pose, n_noisy=self.n_particles - 1)
 
     def update(self, lidar_observation):
         """
@@ -79,55 +90,122 @@ class ParticleFilter:
         @return:
 
         Carries out the Update step of the Particle Filter. It basically updates the weights of the particles using map-correlation.
+        The weights are kept in log space, the correlation divided by the temperature is added to them and they are normalised with log-sum-exp.
+        With scan matching enabled, every particle is also snapped to the best pose in a small neighbourhood around it.
+        With a coarse level, all the particles are first scored on the map pyramid and only the refine_top_k best ones at full resolution.
+        With several workers, the particles are split across them, except for the coarse-to-fine scoring.
+        The observation model either counts the beams ending in occupied cells of the map, 'hits', or sums the likelihood field of the map at the
+        beam end points, 'likelihood'.
         """
         if lidar_observation is None:
             print("No Lidar Observation")
             return
 
+        particles = self.particles
+        instruments = self.instruments
+
         # Find the weights of the particles
         if self.enable_dead_reckoning:
-            self.best_particle = self.one_particle
+            particles.set_best(0, 0.0)
         else:
-            # TODO: MAP Correlation
-            max_weight = 0
-            for i in range(self.particle_poses.shape[0]):
-                lidar_coord_particle = convert_to_world_frame(self.particle_poses[i, 2], self.particle_poses[i, :2], lidar_observation[:, :2])
-                self.particle_weights[i] = self.map.map_correlation(lidar_coord_particle)
-                if self.particle_weights[i] > max_weight:
-                    max_weight = self.particle_weights[i]
+            # Correlate the scan for all the particles at once
+            scorer = self.scorer if self.scorer is not None else self.map
+            with instruments.timer('correlation'):
+                if self.enable_scan_matching:
+                    poses, scores = scorer.scan_match(particles.poses, lidar_observation[:, :2], model=self.observation_model)
+                    particles.poses[:] = poses
+                elif self.coarse_level > 0:
+                    scores = self.map.map_correlation_coarse_to_fine(particles.poses, lidar_observation[:, :2], self.coarse_level,
+                                                                       self.refine_top_k, model=self.observation_model)
+                else:
+                    scores = scorer.map_correlation_batch(particles.poses, lidar_observation[:, :2], model=self.observation_model)
+            if instruments.enabled:
+                instruments.observe('correlation_cells', self.correlation_cost(lidar_observation.shape[0]))
+            particles.log_weight += scores / self.temperature
+            particles.log_weight -= log_sum_exp(particles.log_weight)
+            self.update_weight_statistics()
 
             # Find the best particle
-            self.particle_weights /= (np.sum(self.particle_weights) + EPSILON)
-            best_particle_pose = self.particle_poses[np.argmax(self.particle_weights)]
-            self.best_particle = Particle(position=best_particle_pose[:2], angle=best_particle_pose[2], weight=max_weight)
+            best_index = np.argmax(particles.log_weight)
+            particles.set_best(best_index, scores[best_index])
 
         # Get the world frame coord for the best particle
-        lidar_coord_world = convert_to_world_frame(self.best_particle.angle, self.best_particle.position, lidar_observation[:, :2])
+        best_pose = particles.best_pose
+        lidar_coord_world = convert_to_world_frame(best_pose[2], best_pose[:2], lidar_observation[:, :2])
 
         # Update the map using the best particles lidar scan
-        self.map.update_free(np.array(self.best_particle.position), lidar_coord_world)
+        with instruments.timer('map_update'):
+            n_free = self.map.update_free(best_pose[:2], lidar_coord_world)
+        instruments.observe('free_cells', n_free)
+
+    def correlation_cost(self, n_beams):
+        """
+        @param n_beams: Number of beams of the scan
+        @return: Number of map cells read to score the particles
+        """
+        if self.enable_scan_matching:
+            return self.n_particles * n_beams * (2 * SCAN_MATCH_RADIUS + 1) ** 2 * len(SCAN_MATCH_YAWS)
+        if 0 < self.coarse_level and self.refine_top_k < self.n_particles:
+            return self.n_particles * len(range(0, n_beams, 1 << self.coarse_level)) + self.refine_top_k * n_beams
+        return self.n_particles * n_beams
+
+    def update_weight_statistics(self):
+        """
+        Refreshes the normalised weights, the effective sample size and the entropy of the weights from the log weights
+        """
+        np.exp(self.particles.log_weight, out=self.weights)
+        self.n_eff = effective_sample_size(self.weights)
+        self.weight_entropy = -np.dot(self.weights, self.particles.log_weight)
 
     def resample(self):
         """
-        Uses Stratified sampling to sample the particles using their weights.
-        """
-        # Do the resampling always
-        # Stratified Resampling
-        sorted_index = np.argsort(self.particle_weights)
-        sorted_particle_poses = self.particle_poses[sorted_index]
-
-        particle_cum = np.cumsum(self.particle_weights)
-        if particle_cum[-1] > 0:
-            new_poses = []
-            for i in range(self.n_particles - 1):
-                n_ = np.random.uniform(0, 1)
-                j = 0
-                while n_ > particle_cum[j]:
-                    j += 1
-                new_poses.append(sorted_particle_poses[j, :])
-            self.particle_poses[:-1] = np.array(new_poses)
-            self.particle_weights = np.ones(self.n_particles) / self.n_particles
+        Resamples the particles using their weights, once the effective sample size drops below resample_threshold * n_particles.
+        The last particle is always kept as it is.
+        """
+        if self.n_eff >= self.resample_threshold * self.n_particles:
+            return
+
+        with self.instruments.timer('resample'):
+            indices = self.resampler(self.weights, self.n_particles - 1, self.rng)
+            self.particles.resample(indices)
+            self.particles.log_weight.fill(-np.log(self.n_particles))
+            self.update_weight_statistics()
+        self.instruments.count('resamples')
+
+    def state(self):
+        """
+        @return: Dict of the arrays of the filter and its map for a checkpoint, with the state of the random number generator
+        """
+        state = self.map.state()
+        state['particles'] = self.particles.snapshot()
+        state['best_pose'] = self.particles.best_pose.copy()
+        state['best_weight'] = np.array(self.particles.best_weight)
+        state['rng'] = np.array(json.dumps(self.rng.bit_generator.state))
+        return state
+
+    def restore(self, state):
+        """
+        Restores the filter and its map from a checkpoint
+        @param state: Dict of the arrays of the checkpoint
+        """
+        if state['particles'].shape != self.particles.data.shape:
+            raise ValueError("The checkpoint has " + str(state['particles'].shape[1]) + " particles, the filter has " + str(self.n_particles))
+        self.map.restore(state)
+        self.particles.restore(state['particles'])
+        self.particles.best_pose[:] = state['best_pose']
+        self.particles.best_weight = state['best_weight'].item()
+        self.rng.bit_generator.state = json.loads(state['rng'].item())
+        self.update_weight_statistics()
+
+    def close(self):
+        """
+        Stops the scoring workers
+        """
+        if self.scorer is not None:
+            self.scorer.close()
+            self.scorer = None
 
     def texture_map(self, coord, pixel_values):
-        stereo_coord_world = convert_to_world_frame(self.best_particle.angle, self.best_particle.position, coord[:, :2])
+        best_pose = self.particles.best_pose
+        stereo_coord_world = convert_to_world_frame(best_pose[2], best_pose[:2], coord[:, :2])
         self.map.build_texture(stereo_coord_world, pixel_values)
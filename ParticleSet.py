@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class ParticleSet:
+    """
+    Struct-of-arrays store of the particles. All the state lives in one contiguous (4, n_particles) float64 array,
+    with one row per field, and the attributes are views into it that are updated in place.
+    """
+    __slots__ = ('data', 'poses', 'x', 'y', 'theta', 'log_weight', 'best_pose', 'best_weight')
+
+    def __init__(self, n_particles):
+        self.data = np.zeros((4, n_particles))
+        self.x, self.y, self.theta, self.log_weight = self.data
+
+        # (n_particles, 3) view of [x, y, theta]
+        self.poses = self.data[:3].T
+        self.log_weight.fill(-np.log(n_particles))
+
+        self.best_pose = np.zeros(3)
+        self.best_weight = 0.0
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def set_best(self, index, weight):
+        """
+        Copies the pose of a particle into best_pose
+        @param index: Index of the best particle
+        @param weight: Weight stored along with it
+        """
+        self.best_pose[:] = self.poses[index]
+        self.best_weight = weight
+
+    def resample(self, indices):
+        """
+        Replaces the leading particles by copies of the given ones, the trailing particles are kept as they are.
+        @param indices: (n,) indices of the particles to copy, n <= n_particles
+        """
+        self.data[:, :indices.shape[0]] = self.data[:, indices]
+
+    def snapshot(self):
+        """
+        @return: Copy of the particle state, (4, n_particles) array with rows x, y, theta, log_weight
+        """
+        return self.data.copy()
+
+    def restore(self, snapshot):
+        self.data[:] = snapshot
@@ -0,0 +1,71 @@
+import queue
+import threading
+
+# Number of items a stage produces ahead of its consumer
+PIPELINE_QUEUE_SIZE = 16
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    def __init__(self, producer, queue_size=PIPELINE_QUEUE_SIZE):
+        """
+        Runs a generator in a background thread that fills a bounded queue, and iterates over its items in order.
+        The generator runs at most queue_size items ahead, and an exception it raises is raised again by the consumer.
+
+        @param producer: Iterator of the items, it is only used by the thread of the stage
+        @param queue_size: Maximum number of items waiting in the queue
+        """
+        self.producer = producer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for item in self.producer:
+                if not self._put(item):
+                    return
+        except Exception as error:
+            self._put(_Failure(error))
+            return
+        self._put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        item = self.queue.get()
+        if item is _END:
+            self.done = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.done = True
+            raise item.error
+        return item
+
+    def close(self):
+        """
+        Stops the thread, the items it has not produced yet are dropped
+        """
+        self.stopped.set()
+        self.done = True
+        self.thread.join()
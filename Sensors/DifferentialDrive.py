@@ -13,34 +13,92 @@ class DifferentialDrive(Sensor):
         self.gyro_index = 0
         self.encoder_current_index = 1
 
-    def load_data(self, filename=None, gyro_path=None, encoder_data=None):
+        # Cumulative odometry and the cursors at the end of every lidar interval, see precompute
+        self.odometry_distance = None
+        self.odometry_theta = None
+        self.odometry_encoder_index = None
+        self.odometry_gyro_index = None
+
+    def load_data(self, filename=None, gyro_path=None, encoder_data=None, chunk_rows=None):
         if gyro_path and encoder_data:
-            self.gyro.load_data(gyro_path)
-            self.encoder.load_data(encoder_data)
+            self.gyro.load_data(gyro_path, chunk_rows=chunk_rows)
+            self.encoder.load_data(encoder_data, chunk_rows=chunk_rows)
         else:
             print("No file name provided")
 
     def read_sample(self):
         theta = 0
-        if self.encoder_current_index < self.encoder.data.shape[0]:
-            while self.gyro_index < self.gyro.data.shape[0] and self.gyro.timestamp[self.gyro_index] < self.encoder.timestamp[self.encoder_current_index]:
-                theta += self.gyro.data[self.gyro_index, 2]
+        if self.encoder.has_sample(self.encoder_current_index):
+            encoder_ts = self.encoder.get_timestamp(self.encoder_current_index)
+            while self.gyro.has_sample(self.gyro_index) and self.gyro.get_timestamp(self.gyro_index) < encoder_ts:
+                theta += self.gyro.get_sample(self.gyro_index)[2]
                 self.gyro_index += 1
 
-            ticks = self.encoder.data[self.encoder_current_index] - self.encoder.data[self.encoder_current_index - 1]
+            ticks = self.encoder.get_sample(self.encoder_current_index) - self.encoder.get_sample(self.encoder_current_index - 1)
             left_dist = np.pi * LEFT_WHEEL_DIAMETER * ticks[0] / (4096.0 * 1)
             right_dist = np.pi * RIGHT_WHEEL_DIAMETER * ticks[1] / (4096.0 * 1)
             dist = (left_dist + right_dist) / 2
 
             self.encoder_current_index += 1
+            self.encoder.release(self.encoder_current_index - 1)
+            self.gyro.release(self.gyro_index)
             return dist, theta
         else:
             print("No more Samples!")
         return None
 
+    def precompute(self, lidar_timestamp):
+        """
+        Integrates the odometry of the whole log in one pass, so that every interval is served by read_interval exactly as read_sample
+        would be called by Vehicle.move.
+        Entry i of odometry_encoder_index is the encoder cursor once the lidar at index i has been moved past, i.e. after the encoder
+        samples before timestamp i + 1 of the lidar. Entry e of odometry_gyro_index is the gyro cursor after reading encoder sample e.
+        @param lidar_timestamp: (L,) timestamps of the lidar scans
+        @return:
+        """
+        encoder_ts = np.asarray(self.encoder.timestamp)
+        ticks = np.diff(np.asarray(self.encoder.data, dtype=np.float64), axis=0)
+        distance = np.zeros(encoder_ts.shape[0])
+        distance[1:] = (np.pi * LEFT_WHEEL_DIAMETER * ticks[:, 0] + np.pi * RIGHT_WHEEL_DIAMETER * ticks[:, 1]) / (4096.0 * 2)
+        self.odometry_distance = np.concatenate(([0], np.cumsum(distance)))
+        self.odometry_theta = np.concatenate(([0], np.cumsum(self.gyro.data[:, 2])))
+
+        # Gyro index after reading every encoder sample
+        gyro_index = np.searchsorted(self.gyro.timestamp, encoder_ts, side='left')
+        gyro_index[0] = 0
+        self.odometry_gyro_index = np.maximum.accumulate(gyro_index)
+
+        # Encoder samples are read while the next encoder timestamp is before the next lidar timestamp
+        end = np.searchsorted(encoder_ts, lidar_timestamp[1:], side='left') - 1
+        self.odometry_encoder_index = np.maximum.accumulate(end)
+
+    def read_interval(self, lidar_index):
+        """
+        Serves the precomputed odometry from the current cursors, and moves them as if the samples had been read one by one.
+        The interval starts at the live cursors, so the first one also covers the samples before the first lidar interval.
+        @param lidar_index: Current index of the lidar
+        @return: [distance, d_theta]
+        """
+        start, gyro_start = self.encoder_current_index, self.gyro_index
+        end = max(int(self.odometry_encoder_index[lidar_index]), start)
+        gyro_end = max(int(self.odometry_gyro_index[end - 1]), gyro_start) if end > start else gyro_start
+
+        self.encoder_current_index, self.gyro_index = end, gyro_end
+        return np.array([self.odometry_distance[end] - self.odometry_distance[start],
+                         self.odometry_theta[gyro_end] - self.odometry_theta[gyro_start]])
+
+    def seek(self, encoder_index, gyro_index):
+        """
+        Moves the cursors of the encoder and the gyro, e.g. to resume a drive
+        """
+        self.encoder_current_index = encoder_index
+        self.gyro_index = gyro_index
+        self.encoder.release(encoder_index - 1)
+        self.gyro.release(gyro_index)
+
     def get_next_timestamp(self):
-        if self.encoder_current_index < self.encoder.data.shape[0]-1 and self.gyro_index < self.gyro.data.shape[0]:
-            return self.encoder.timestamp[self.encoder_current_index+1]
+        if self.encoder.has_sample(self.encoder_current_index+1) and self.gyro.has_sample(self.gyro_index):
+            return self.encoder.get_timestamp(self.encoder_current_index+1)
         else:
             print("No more Samples!")
         return None
@@ -1,7 +1,89 @@
+import numpy as np
+
 from Sensors.Sensor import Sensor
 
+# Only the ranges within (LIDAR_MIN_RANGE, LIDAR_MAX_RANGE) are valid
+LIDAR_MIN_RANGE = 0.1
+LIDAR_MAX_RANGE = 40
+# Number of scans converted together by precompute, bounds the size of the (scans x beams x 3) buffer
+LIDAR_CONVERT_BLOCK = 4096
+
 
 class Lidar(Sensor):
-    def __init__(self, param_file):
+    def __init__(self, param_file, angles=None):
+        """
+        @param param_file: Lidar to vehicle parameters
+        @param angles: (B,) angles of the beams in radians, see set_angles
+        """
         super().__init__(param_file)
+        self.directions = None
+        self.buffer = None
+
+        # End points of all the scans of the log, the ones of scan i are points[offsets[i]:offsets[i + 1]], see precompute
+        self.points = None
+        self.offsets = None
+        if angles is not None:
+            self.set_angles(angles)
+
+    def set_angles(self, angles):
+        """
+        Precomputes the unit vectors of the beams rotated into the body frame, so the end point of a beam is its range times its vector
+        @param angles: (B,) angles of the beams in radians
+        """
+        beams = np.stack((np.cos(angles), np.sin(angles), np.zeros(angles.shape[0])), axis=1)
+        self.directions = beams @ self.rotation_matrix.T
+        self.buffer = np.empty((1, angles.shape[0], 3))
+
+    def convert_batch(self, ranges, out=None):
+        """
+        Converts scans to end points in the body frame
+        @param ranges: (S, B) ranges of S scans
+        @param out: (S, B, 3) buffer the end points are written to, allocated if None
+        @return: (S, B, 3) end points of all the beams, and (S, B) mask of the valid ones
+        """
+        ranges = np.asarray(ranges)
+        if out is None:
+            out = np.empty(ranges.shape + (3,))
+        np.multiply(ranges[..., np.newaxis], self.directions, out=out)
+        valid = (ranges < LIDAR_MAX_RANGE) & (ranges > LIDAR_MIN_RANGE)
+        return out, valid
+
+    def convert(self, ranges):
+        """
+        @param ranges: (B,) ranges of a scan
+        @return: (N, 3) end points of the valid beams in the body frame
+        """
+        points, valid = self.convert_batch(ranges[np.newaxis], out=self.buffer)
+        return points[0][valid[0]]
+
+    def precompute(self):
+        """
+        Converts all the scans of the loaded log in one pass, block by block. Only the valid end points are kept, packed one scan
+        after the other, so it takes about 24 bytes per valid beam.
+        @return:
+        """
+        valid = (np.asarray(self.data) < LIDAR_MAX_RANGE) & (np.asarray(self.data) > LIDAR_MIN_RANGE)
+        self.offsets = np.concatenate(([0], np.cumsum(np.count_nonzero(valid, axis=1))))
+        self.points = np.empty((self.offsets[-1], 3))
+
+        buffer = np.empty((LIDAR_CONVERT_BLOCK,) + valid.shape[1:] + (3,))
+        for start in range(0, valid.shape[0], LIDAR_CONVERT_BLOCK):
+            end = min(start + LIDAR_CONVERT_BLOCK, valid.shape[0])
+            points, _ = self.convert_batch(self.data[start:end], out=buffer[:end - start])
+            self.points[self.offsets[start]:self.offsets[end]] = points[valid[start:end]]
+
+    def read_scan(self):
+        """
+        Reads the next scan like read_sample
+        @return: (N, 3) end points of its valid beams in the body frame, from the precomputed ones if any
+        """
+        if self.points is None:
+            ranges = self.read_sample()
+            return None if ranges is None else self.convert(ranges)
 
+        if not self.has_sample(self.current_index):
+            print("No more Samples!")
+            return None
+        index = self.current_index
+        self.current_index += 1
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
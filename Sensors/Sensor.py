@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 
+from Sensors.SensorStream import SensorStream, csv_chunks, log_chunks
+from Sensors.sensor_log import LOG_EXTENSION, load_log
+
 
 class Sensor:
     def __init__(self, param_file=None):
@@ -10,13 +13,55 @@ class Sensor:
         self.data = None
         self.timestamp = None
         self.current_index = 0
+        self.stream = None
         if param_file:
             self.get_transition_matrix(param_file)
 
-    def load_data(self, filename):
-        data_csv = pd.read_csv(filename, header=None)
-        self.data = data_csv.values[:, 1:]
-        self.timestamp = data_csv.values[:, 0]
+    def load_data(self, filename, chunk_rows=None):
+        """
+        @param filename: Path of a csv or binary sensor log
+        @param chunk_rows: If set, the log is streamed in chunks of this many rows instead of being loaded at once
+        @return:
+        """
+        if chunk_rows:
+            chunks = log_chunks(filename, chunk_rows) if filename.endswith(LOG_EXTENSION) else csv_chunks(filename, chunk_rows)
+            self.stream = SensorStream(chunks)
+        elif filename.endswith(LOG_EXTENSION):
+            self.timestamp, self.data = load_log(filename)
+        else:
+            data_csv = pd.read_csv(filename, header=None)
+            self.data = data_csv.values[:, 1:]
+            self.timestamp = data_csv.values[:, 0]
+
+    def has_sample(self, index):
+        if self.stream is not None:
+            return self.stream.has(index)
+        return index < self.timestamp.shape[0]
+
+    def get_sample(self, index):
+        if self.stream is not None:
+            return self.stream.data_at(index)
+        return self.data[index]
+
+    def get_timestamp(self, index):
+        if self.stream is not None:
+            return self.stream.timestamp_at(index)
+        return self.timestamp[index]
+
+    def release(self, index):
+        """
+        Lets a streamed log drop the samples before index
+        """
+        if self.stream is not None:
+            self.stream.release(index)
+
+    def seek(self, index):
+        """
+        Moves the cursor to a sample, a streamed log reads up to it on the next read
+        @param index: Index of the next sample to read
+        """
+        self.current_index = index
+        self.release(index)
 
     def get_transition_matrix(self, filename):
         with open(filename) as f:
@@ -36,16 +81,17 @@ class Sensor:
 
     def read_sample(self):
         data = None
-        if self.current_index < self.data.shape[0]:
-            data = self.data[self.current_index]
+        if self.has_sample(self.current_index):
+            data = self.get_sample(self.current_index)
             self.current_index += 1
+            self.release(self.current_index)
         else:
             print("No more Samples!")
         return data
 
     def get_next_timestamp(self):
-        if self.current_index < self.timestamp.shape[0]-1:
-            return self.timestamp[self.current_index+1]
+        if self.has_sample(self.current_index+1):
+            return self.get_timestamp(self.current_index+1)
         else:
             print("No more Samples!")
         return None
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+from Sensors.sensor_log import load_log
+
+STREAM_CHUNK_ROWS = 10000
+
+
+def csv_chunks(filename, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    @param filename: Path of a csv sensor log, with the timestamp in the first column
+    @param chunk_rows: Number of rows per chunk
+    @return: Iterator of (timestamps, data) chunks
+    """
+    for chunk in pd.read_csv(filename, header=None, dtype={0: np.int64}, chunksize=chunk_rows):
+        yield chunk[0].to_numpy(), chunk.iloc[:, 1:].to_numpy()
+
+
+def log_chunks(filename, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    @param filename: Path of a binary sensor log
+    @param chunk_rows: Number of rows per chunk
+    @return: Iterator of (timestamps, data) chunks, copied out of the memory map
+    """
+    timestamp, data = load_log(filename)
+    for start in range(0, timestamp.shape[0], chunk_rows):
+        yield np.array(timestamp[start:start + chunk_rows]), np.array(data[start:start + chunk_rows])
+
+
+class SensorStream:
+    def __init__(self, chunks):
+        """
+        Bounded window over a sensor log that is read chunk by chunk. Rows are addressed by their absolute index in the log,
+        the window holds the rows from the last released index up to the end of the last chunk read ahead.
+
+        @param chunks: Iterator of (timestamps, data) chunks
+        """
+        self.chunks = chunks
+        self.start = 0
+        self.released = 0
+        self.timestamp = None
+        self.data = None
+        self.exhausted = False
+
+    def _read_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+
+        # The whole window is released, e.g. after a seek, the released rows of the new chunk are dropped as well
+        chunk_start = self.start + (0 if self.timestamp is None else self.timestamp.shape[0])
+        if self.timestamp is None or self.released >= chunk_start:
+            skip = min(max(self.released - chunk_start, 0), chunk[0].shape[0])
+            self.timestamp, self.data = chunk[0][skip:], chunk[1][skip:]
+            self.start = chunk_start + skip
+            return
+
+        # Drop the released rows and append the new chunk
+        keep = self.released - self.start
+        self.timestamp = np.concatenate((self.timestamp[keep:], chunk[0]))
+        self.data = np.concatenate((self.data[keep:], chunk[1]))
+        self.start = self.released
+
+    def has(self, index):
+        """
+        Reads ahead until the row is in the window or the log ends
+        @param index: Absolute index of the row
+        @return: True if the log has this row
+        """
+        while not self.exhausted and (self.timestamp is None or index >= self.start + self.timestamp.shape[0]):
+            self._read_chunk()
+        return self.timestamp is not None and index < self.start + self.timestamp.shape[0]
+
+    def release(self, index):
+        """
+        The rows before index are no longer needed and are dropped on the next read
+        @param index: Absolute index of the first row still needed
+        """
+        self.released = max(self.released, index)
+
+    def timestamp_at(self, index):
+        assert self.start <= index
+        return self.timestamp[index - self.start]
+
+    def data_at(self, index):
+        assert self.start <= index
+        return self.data[index - self.start]
@@ -3,6 +3,7 @@ import os
 import cv2
 import numpy as np
 
+from Pipeline import PIPELINE_QUEUE_SIZE, Stage
 from Sensors.Sensor import Sensor
 
 Z_MIN = -10
@@ -22,13 +23,27 @@ class Camera:
 
 
 class Stereo(Sensor):
-    def __init__(self, left_camera_config_file, right_camera_config_file, param_file):
+    def __init__(self, left_camera_config_file, right_camera_config_file, param_file, pixel_step=1, prefetch=False):
+        """
+        @param pixel_step: Only every pixel_step-th row and column of the disparity is projected
+        @param prefetch: Read and convert the next image pairs in a background thread
+        """
         super().__init__(param_file)
         self.left_camera_data_folder = None
         self.right_camera_data_folder = None
         self.left_camera = Camera(left_camera_config_file)
         self.right_camera = Camera(right_camera_config_file)
         self.depth_constant = (self.left_camera.project_matrix - self.right_camera.project_matrix)[0, 3]
+        self.pixel_step = pixel_step
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.prefetch_index = None
+
+        # TODO: Fine-tune the variables `numDisparities` and `blockSize` based on the desired accuracy
+        self.stereo_matcher = cv2.StereoBM_create(numDisparities=32, blockSize=9)
+
+        # Body frame ray of every projected pixel in row-major order, built for the size of the first image
+        self.rays = None
 
     def load_data(self, folder_path1, folder_path2):
         self.data = None
@@ -37,6 +52,74 @@ class Stereo(Sensor):
         left_ts = np.sort([f[:-4] for f in os.listdir(folder_path1) if os.path.isfile(os.path.join(folder_path1, f))])
         right_ts = np.sort([f[:-4] for f in os.listdir(folder_path2) if os.path.isfile(os.path.join(folder_path2, f))])
         self.timestamp = left_ts[left_ts == right_ts].astype(int)
+        self.stop_prefetch()
+
+    def read_images(self, index):
+        """
+        @param index: Index of the image pair
+        @return: Left colour image, left and right grayscale images
+        """
+        filename = str(self.timestamp[index]) + ".png"
+
+        left_img = cv2.imread(os.path.join(self.left_camera_data_folder, filename), 0)
+        right_img = cv2.imread(os.path.join(self.right_camera_data_folder, filename), 0)
+
+        left_img_colour = cv2.cvtColor(left_img, cv2.COLOR_BAYER_BG2BGR)
+        right_img_colour = cv2.cvtColor(right_img, cv2.COLOR_BAYER_BG2BGR)
+
+        left_img = cv2.cvtColor(left_img_colour, cv2.COLOR_BGR2GRAY)
+        right_img = cv2.cvtColor(right_img_colour, cv2.COLOR_BGR2GRAY)
+        return left_img_colour, left_img, right_img
+
+    def _image_pairs(self, index):
+        for i in range(index, self.timestamp.shape[0]):
+            yield self.read_images(i)
+
+    def next_images(self):
+        """
+        @return: Images of the current index, from the prefetcher if it is enabled
+        """
+        if not self.prefetch:
+            return self.read_images(self.current_index)
+
+        # The frames skipped since the last read are dropped from the prefetcher, it is only restarted if the index moved back,
+        # e.g. after a seek, or further ahead than it prefetches
+        skipped = None if self.prefetcher is None else self.current_index - self.prefetch_index
+        if skipped is None or not 0 <= skipped <= PIPELINE_QUEUE_SIZE:
+            self.stop_prefetch()
+            self.prefetcher = Stage(self._image_pairs(self.current_index))
+        else:
+            for _ in range(skipped):
+                next(self.prefetcher)
+        self.prefetch_index = self.current_index + 1
+        return next(self.prefetcher)
+
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def body_rays(self, shape):
+        """
+        The inverse camera model and the rotation to the body frame are both linear, so they are applied once per pixel
+        and the body frame coordinates of a pixel are its depth times its ray.
+        @param shape: Shape of the images
+        @return: (rows * cols, 3) body frame rays of the pixels [::pixel_step, ::pixel_step], in row-major order
+        """
+        if self.rays is None:
+            xs, ys = np.meshgrid(np.arange(0, shape[0], self.pixel_step), np.arange(0, shape[1], self.pixel_step), indexing='ij')
+            pixel_coords = np.stack((xs.ravel(), ys.ravel(), np.ones(xs.size)), axis=-1)
+            self.rays = pixel_coords @ (self.rotation_matrix @ self.left_camera.inverse_projection_matrix).T
+        return self.rays
+
+    def skip_sample(self):
+        """
+        Moves to the next frame without reading it, a prefetched frame is dropped on the next read
+        """
+        if self.current_index < self.timestamp.shape[0]:
+            self.current_index += 1
+        else:
+            print("No more Samples!")
 
     def read_sample(self):
         assert self.left_camera_data_folder is not None
@@ -44,37 +127,24 @@ class Stereo(Sensor):
 
         if self.current_index < self.timestamp.shape[0]:
             # Read Image and convert to grayscale
-            filename = str(self.timestamp[self.current_index]) + ".png"
-
-            left_img = cv2.imread(os.path.join(self.left_camera_data_folder, filename), 0)
-            right_img = cv2.imread(os.path.join(self.right_camera_data_folder, filename), 0)
-
-            left_img_colour = cv2.cvtColor(left_img, cv2.COLOR_BAYER_BG2BGR)
-            right_img_colour = cv2.cvtColor(right_img, cv2.COLOR_BAYER_BG2BGR)
-
-            left_img = cv2.cvtColor(left_img_colour, cv2.COLOR_BGR2GRAY)
-            right_img = cv2.cvtColor(right_img_colour, cv2.COLOR_BGR2GRAY)
+            left_img_colour, left_img, right_img = self.next_images()
 
-            # TODO: Fine-tune the variables `numDisparities` and `blockSize` based on the desired accuracy
-            stereo = cv2.StereoBM_create(numDisparities=32, blockSize=9)
-            disparity = stereo.compute(left_img, right_img)
+            disparity = self.stereo_matcher.compute(left_img, right_img)[::self.pixel_step, ::self.pixel_step]
 
-            # Get Valid Depth coordinates
-            depth = self.depth_constant / (disparity + EPSILON)
-            xs, ys = np.where((depth > 0) & (depth != np.inf))
-            pixel_values = left_img_colour[xs, ys]
+            # Get Valid Depth coordinates, the depth constant is positive so the depth is valid for the disparities >= 0.
+            # The pixels are addressed by their flat index, which gathers faster than (row, col) pairs
+            valid = np.flatnonzero(disparity >= 0)
+            depth = self.depth_constant / (disparity.ravel()[valid] + EPSILON)
 
-            # Apply the inverse camera model
-            pixel_coords = np.stack((xs, ys, np.ones(xs.shape[0]))).T
-            canonical_coords = self.left_camera.convert_to_canonical_frame(pixel_coords)
-            optical_coords = depth[xs, ys][:, np.newaxis] * canonical_coords
-            regular_coord = self.convert_to_body_frame(optical_coords)
-            z_coord = regular_coord[:, 2]
-            threshold_ind = np.where((z_coord > Z_MIN) & (z_coord < Z_MAX))
+            # Drop the pixels out of the height range before projecting the others
+            rays = self.body_rays(left_img.shape)
+            z_coord = depth * rays[valid, 2]
+            threshold_ind = (z_coord > Z_MIN) & (z_coord < Z_MAX)
+            valid, depth = valid[threshold_ind], depth[threshold_ind]
 
-            # Coord and Pixel values
-            valid_coord = regular_coord[threshold_ind]
-            pixel_values = pixel_values[threshold_ind]
+            # Apply the inverse camera model and the rotation to the body frame
+            valid_coord = depth[:, np.newaxis] * rays[valid]
+            pixel_values = left_img_colour[::self.pixel_step, ::self.pixel_step].reshape(-1, 3)[valid]
 
             self.current_index += 1
             return valid_coord, pixel_values
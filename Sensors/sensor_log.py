@@ -0,0 +1,95 @@
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+# Binary columnar sensor log:
+#   header      magic, number of rows, number of columns, data dtype, offsets of the two blocks
+#   timestamps  int64 column of n_rows
+#   data        n_rows x n_cols row-major matrix of the data dtype
+LOG_EXTENSION = '.bin'
+LOG_MAGIC = b'PFSLOG01'
+LOG_HEADER = struct.Struct('<8sqq8sqq')
+LOG_ALIGNMENT = 64
+CSV_CHUNK_ROWS = 100000
+
+
+def _align(offset):
+    return (offset + LOG_ALIGNMENT - 1) // LOG_ALIGNMENT * LOG_ALIGNMENT
+
+
+def _count_rows(filename):
+    n_rows = 0
+    last = b'\n'
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            n_rows += block.count(b'\n')
+            last = block[-1:]
+    return n_rows + (last != b'\n')
+
+
+def log_path(filename):
+    """
+    @param filename: Path of a csv sensor log
+    @return: Path of its binary log
+    """
+    return os.path.splitext(filename)[0] + LOG_EXTENSION
+
+
+def convert_csv_to_log(csv_file, out_file, dtype):
+    """
+    Converts a csv sensor log, with the timestamp in the first column, to the binary columnar format.
+    The csv is read in chunks, so the conversion runs on logs larger than the memory.
+    @param csv_file: Path of the csv log
+    @param out_file: Path of the binary log to write
+    @param dtype: dtype of the data columns, e.g. float32 ranges or int32 encoder ticks
+    @return:
+    """
+    dtype = np.dtype(dtype)
+    n_rows = _count_rows(csv_file)
+    n_cols = pd.read_csv(csv_file, header=None, nrows=1).shape[1] - 1
+
+    timestamp_offset = _align(LOG_HEADER.size)
+    data_offset = _align(timestamp_offset + 8 * n_rows)
+    with open(out_file, 'wb') as f:
+        f.write(LOG_HEADER.pack(LOG_MAGIC, n_rows, n_cols, dtype.str.encode(), timestamp_offset, data_offset))
+        f.truncate(data_offset + dtype.itemsize * n_rows * n_cols)
+
+    timestamp = np.memmap(out_file, dtype=np.int64, mode='r+', offset=timestamp_offset, shape=(n_rows,))
+    data = np.memmap(out_file, dtype=dtype, mode='r+', offset=data_offset, shape=(n_rows, n_cols))
+    start = 0
+    for chunk in pd.read_csv(csv_file, header=None, dtype={0: np.int64}, chunksize=CSV_CHUNK_ROWS):
+        values = chunk.iloc[:, 1:].to_numpy()
+        if dtype.kind in 'iu' and values.size and (values.min() < np.iinfo(dtype).min or values.max() > np.iinfo(dtype).max):
+            raise ValueError("Values of " + csv_file + " do not fit in " + dtype.name)
+        end = start + chunk.shape[0]
+        timestamp[start:end] = chunk[0].to_numpy()
+        data[start:end] = values
+        start = end
+    timestamp.flush()
+    data.flush()
+    del timestamp, data
+
+    # Blank lines are counted by _count_rows but not read, shrink the log to the rows written so no zero rows are left at its end
+    if start != n_rows:
+        with open(out_file, 'r+b') as f:
+            f.write(LOG_HEADER.pack(LOG_MAGIC, start, n_cols, dtype.str.encode(), timestamp_offset, data_offset))
+            f.truncate(data_offset + dtype.itemsize * start * n_cols)
+
+
+def load_log(filename):
+    """
+    Memory maps a binary sensor log, only the pages that are read are loaded
+    @param filename: Path of the binary log
+    @return: (n_rows,) int64 timestamps and (n_rows, n_cols) data
+    """
+    with open(filename, 'rb') as f:
+        magic, n_rows, n_cols, dtype, timestamp_offset, data_offset = LOG_HEADER.unpack(f.read(LOG_HEADER.size))
+    if magic != LOG_MAGIC:
+        raise ValueError(filename + " is not a sensor log")
+
+    dtype = np.dtype(dtype.rstrip(b'\0').decode())
+    timestamp = np.memmap(filename, dtype=np.int64, mode='r', offset=timestamp_offset, shape=(n_rows,))
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=data_offset, shape=(n_rows, n_cols))
+    return timestamp, data
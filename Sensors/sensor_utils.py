@@ -1,22 +1,6 @@
 import numpy as np
 
 
-def convert_angle_coord(angles, distances):
-    coord = np.zeros((angles.shape[0], 2))
-    coord[:, 0] = distances * np.cos(angles)
-    coord[:, 1] = distances * np.sin(angles)
-    return coord
-
-
-def unique(a):
-    order = np.lexsort(a.T)
-    a = a[order]
-    diff = np.diff(a, axis=0)
-    ui = np.ones(len(a), 'bool')
-    ui[1:] = (diff != 0).any(axis=1)
-    return a[ui]
-
-
 def bresenham2D(sx, sy, ex, ey):
     '''
     Bresenham's ray tracing algorithm in 2D.
@@ -59,31 +43,46 @@ def bresenham2D(sx, sy, ex, ey):
     return np.vstack((x, y))
 
 
-def get_mapping(bot_pos, points):
-    free_points = None
-    block_points = None
-    for p in points:
-        point_space = bresenham2D(bot_pos[0], bot_pos[1], p[0], p[1]).T
-
-        if free_points is None:
-            free_points = point_space[:-1, :]
-            block_points = point_space[-1:, :]
-        else:
-            free_points = np.concatenate((free_points, point_space[:-1, :]))
-            block_points = np.concatenate((block_points, point_space[-1:, :]))
-
-    new_free = None
-    if free_points is not None:
-        new_free = unique(free_points).astype(np.int16)
-
-    return new_free
-
-
-def get_valid(angles, ranges):
-    indValid = np.logical_and((ranges < 40), (ranges > 0.1))
-    ranges = ranges[indValid]
-    angles = angles[indValid]
-    return angles, ranges
-
-
+def bresenham2D_batch(sx, sy, ex, ey):
+    '''
+    Vectorised Bresenham ray tracing for many rays sharing one start point.
+    Produces exactly the cells of bresenham2D, laid out on a padded grid with one row per ray.
+    Inputs:
+        (sx, sy)	start point of all the rays
+        (ex, ey)	arrays with the end points of the rays
+    Outputs:
+        x, y		(N, L) cell coordinates, only the first n_cells[i] entries of row i are valid
+        n_cells		number of cells traced by each ray, end point included
+    '''
+    sx = int(round(sx))
+    sy = int(round(sy))
+    ex = np.rint(ex).astype(np.int64)
+    ey = np.rint(ey).astype(np.int64)
+    dx = np.abs(ex - sx)
+    dy = np.abs(ey - sy)
+    steep = dy > dx
+
+    # Walk one cell per step along the major axis, the minor axis offset has a closed form
+    major = np.where(steep, dy, dx)
+    minor = np.where(steep, dx, dy)
+    k = np.arange(major.max() + 1 if major.shape[0] > 0 else 1)
+    offset = -(((major // 2)[:, np.newaxis] - k * minor[:, np.newaxis]) // np.maximum(major, 1)[:, np.newaxis])
+
+    x_step = np.where(ex >= sx, 1, -1)[:, np.newaxis]
+    y_step = np.where(ey >= sy, 1, -1)[:, np.newaxis]
+    x = sx + x_step * np.where(steep[:, np.newaxis], offset, k)
+    y = sy + y_step * np.where(steep[:, np.newaxis], k, offset)
+    return x, y, major + 1
+
+
+def trace_free(bot_pos, points):
+    '''
+    Traces the rays from bot_pos to the end points. A cell crossed by several rays is returned once per ray.
+    Outputs:
+        x, y		coordinates of the free cells, i.e. all the cells of the rays but their end points
+    '''
+    x, y, n_cells = bresenham2D_batch(bot_pos[0], bot_pos[1], points[:, 0], points[:, 1])
 
+    # The last cell of every ray is the obstacle, all the cells before it are free
+    free = np.arange(x.shape[1]) < (n_cells - 1)[:, np.newaxis]
+    return x[free], y[free]
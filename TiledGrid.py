@@ -0,0 +1,137 @@
+import numpy as np
+
+TILE_SHIFT = 8
+TILE_SIZE = 1 << TILE_SHIFT
+
+# Gathers of at least 1 / DENSE_GATHER_RATIO cells of the tiles they cover are read from a dense crop
+DENSE_GATHER_RATIO = 16
+
+
+class TiledGrid:
+    def __init__(self, fill_value=0, dtype=np.float64, channels=None):
+        """
+        Unbounded 2D grid stored as TILE_SIZE x TILE_SIZE tiles in a dict keyed by tile coordinate. Tiles are allocated the first time one of their
+        cells is written, and cells of missing tiles read as fill_value. Cells are indexed like a numpy array, grid[xs, ys], with integer arrays of any
+        shape and any sign.
+
+        @param fill_value: Value of the cells that have never been written
+        @param dtype: dtype of the cells
+        @param channels: If set, every cell holds a vector of this many values, like an HxWxC image
+        """
+        self.fill_value = fill_value
+        self.dtype = np.dtype(dtype)
+        self.cell_shape = () if channels is None else (channels,)
+        self.tiles = {}
+
+    def _new_tile(self):
+        return np.full((TILE_SIZE, TILE_SIZE) + self.cell_shape, self.fill_value, dtype=self.dtype)
+
+    @staticmethod
+    def _split(xs, ys):
+        """
+        Groups the cells by tile without sorting them
+        @return: Iterator of ((tx, ty), mask of the cells in that tile), the in-tile x and y of all the cells
+        """
+        tx, ty = xs >> TILE_SHIFT, ys >> TILE_SHIFT
+        local_x, local_y = xs & (TILE_SIZE - 1), ys & (TILE_SIZE - 1)
+        if xs.shape[0] == 0:
+            return [], local_x, local_y
+
+        tx_min, ty_min = tx.min(), ty.min()
+        n_ty = ty.max() - ty_min + 1
+        key = (tx - tx_min) * n_ty + (ty - ty_min)
+        present = np.flatnonzero(np.bincount(key))
+        if present.shape[0] == 1:
+            groups = [((tx_min + present[0] // n_ty, ty_min + present[0] % n_ty), slice(None))]
+        else:
+            groups = [((tx_min + k // n_ty, ty_min + k % n_ty), key == k) for k in present]
+        return groups, local_x, local_y
+
+    def __getitem__(self, index):
+        xs, ys = np.broadcast_arrays(*index)
+        shape = xs.shape
+        xs, ys = xs.ravel().astype(np.int64), ys.ravel().astype(np.int64)
+
+        # Large gathers, like the correlation of many particles, read from a dense crop of the tiles they cover
+        if xs.shape[0] > 0:
+            x0, y0 = (xs.min() >> TILE_SHIFT) << TILE_SHIFT, (ys.min() >> TILE_SHIFT) << TILE_SHIFT
+            x1, y1 = ((xs.max() >> TILE_SHIFT) + 1) << TILE_SHIFT, ((ys.max() >> TILE_SHIFT) + 1) << TILE_SHIFT
+            if xs.shape[0] * DENSE_GATHER_RATIO >= (x1 - x0) * (y1 - y0):
+                return self.crop(int(x0), int(y0), int(x1), int(y1))[xs - x0, ys - y0].reshape(shape + self.cell_shape)
+
+        values = np.full(xs.shape + self.cell_shape, self.fill_value, dtype=self.dtype)
+
+        groups, local_x, local_y = self._split(xs, ys)
+        for key, mask in groups:
+            tile = self.tiles.get((int(key[0]), int(key[1])))
+            if tile is not None:
+                values[mask] = tile[local_x[mask], local_y[mask]]
+        return values.reshape(shape + self.cell_shape)
+
+    def __setitem__(self, index, values):
+        xs, ys = np.broadcast_arrays(*index)
+        xs, ys = xs.ravel().astype(np.int64), ys.ravel().astype(np.int64)
+        values = np.broadcast_to(values, xs.shape + self.cell_shape)
+
+        groups, local_x, local_y = self._split(xs, ys)
+        for key, mask in groups:
+            key = (int(key[0]), int(key[1]))
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self.tiles[key] = self._new_tile()
+            tile[local_x[mask], local_y[mask]] = values[mask]
+
+    def crop(self, x0, y0, x1, y1):
+        """
+        @return: Dense copy of the cells [x0, x1) x [y0, y1)
+        """
+        out = np.full((x1 - x0, y1 - y0) + self.cell_shape, self.fill_value, dtype=self.dtype)
+        for tx in range(x0 >> TILE_SHIFT, ((x1 - 1) >> TILE_SHIFT) + 1):
+            for ty in range(y0 >> TILE_SHIFT, ((y1 - 1) >> TILE_SHIFT) + 1):
+                tile = self.tiles.get((tx, ty))
+                if tile is None:
+                    continue
+                cx0, cy0 = max(x0, tx << TILE_SHIFT), max(y0, ty << TILE_SHIFT)
+                cx1, cy1 = min(x1, (tx + 1) << TILE_SHIFT), min(y1, (ty + 1) << TILE_SHIFT)
+                out[cx0 - x0:cx1 - x0, cy0 - y0:cy1 - y0] = tile[cx0 - (tx << TILE_SHIFT):cx1 - (tx << TILE_SHIFT),
+                                                                 cy0 - (ty << TILE_SHIFT):cy1 - (ty << TILE_SHIFT)]
+        return out
+
+    def paste(self, x0, y0, block):
+        """
+        Writes a dense block with its [0, 0] at cell (x0, y0)
+        """
+        x1, y1 = x0 + block.shape[0], y0 + block.shape[1]
+        for tx in range(x0 >> TILE_SHIFT, ((x1 - 1) >> TILE_SHIFT) + 1):
+            for ty in range(y0 >> TILE_SHIFT, ((y1 - 1) >> TILE_SHIFT) + 1):
+                tile = self.tiles.get((tx, ty))
+                if tile is None:
+                    tile = self.tiles[(tx, ty)] = self._new_tile()
+                cx0, cy0 = max(x0, tx << TILE_SHIFT), max(y0, ty << TILE_SHIFT)
+                cx1, cy1 = min(x1, (tx + 1) << TILE_SHIFT), min(y1, (ty + 1) << TILE_SHIFT)
+                tile[cx0 - (tx << TILE_SHIFT):cx1 - (tx << TILE_SHIFT),
+                     cy0 - (ty << TILE_SHIFT):cy1 - (ty << TILE_SHIFT)] = block[cx0 - x0:cx1 - x0, cy0 - y0:cy1 - y0]
+
+    def bounds(self):
+        """
+        @return: (x0, y0, x1, y1) covering all the allocated tiles, None if there are none
+        """
+        if not self.tiles:
+            return None
+        keys = np.array(list(self.tiles.keys()))
+        x0, y0 = keys.min(axis=0) << TILE_SHIFT
+        x1, y1 = (keys.max(axis=0) + 1) << TILE_SHIFT
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def to_dense(self):
+        """
+        @return: Dense copy of the allocated extent and its (x0, y0) origin
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return np.full((1, 1) + self.cell_shape, self.fill_value, dtype=self.dtype), (0, 0)
+        return self.crop(*bounds), bounds[:2]
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
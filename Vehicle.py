@@ -1,10 +1,17 @@
 import os
+import time
 
+from Instrumentation import PROFILE_INTERVAL, STATS_EVERY, SamplingProfiler, make_instruments
+from KeyframePolicy import KeyframePolicy
+from checkpoint import load_checkpoint, save_checkpoint
 from ParticleFilter import *
+from Pipeline import Stage
 from Sensors.DifferentialDrive import DifferentialDrive
 from Sensors.Lidar import Lidar
 from Sensors.Stereo import Stereo
+from Sensors.sensor_log import log_path
 from Sensors.sensor_utils import *
+from Visualization import DISPLAYS, SnapshotWriter
 
 PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -29,28 +36,109 @@ RIGHT_CAMERA_CONFIG_FILE_PATH = os.path.join(PARAM_PATH, "right_camera.yaml")
 
 LIDAR_ANGLES = np.linspace(-5, 185, 286) / 180 * np.pi
 
+# dtypes of the data columns in the binary sensor logs
+SENSOR_LOG_DTYPES = {
+    LIDAR_DATA_FILE: np.float32,
+    FOG_DATA_FILE: np.float64,
+    ENCODER_DATA_FILE: np.int32,
+}
+
+
+def data_file(data_path, filename):
+    """
+    @param data_path: Data directory laid out like DATA_PATH
+    @param filename: One of the paths under DATA_PATH, e.g. LIDAR_DATA_FILE
+    @return: The same path under data_path
+    """
+    return os.path.join(data_path, os.path.relpath(filename, DATA_PATH))
+
+
+def get_sensor_file(filename):
+    """
+    @param filename: Path of a csv sensor log
+    @return: Path of its binary log if it has been converted, the csv path otherwise
+    """
+    binary_file = log_path(filename)
+    return binary_file if os.path.isfile(binary_file) else filename
+
 
 class Vehicle:
-    def __init__(self, n_particles=20, enable_texture_mapping=False, enable_dead_reckoning=False):
+    def __init__(self, n_particles=20, enable_texture_mapping=False, enable_dead_reckoning=False, enable_scan_matching=False, seed=None,
+                 resampling='stratified', resample_threshold=0.5, temperature=1.0, chunk_rows=None,
+                 tiled_map=False, map_odds_dtype='float64', coarse_level=0, refine_top_k=None,
+                 observation_model='hits', n_workers=1, parallel_mode='thread', pipeline=False,
+                 texture_step=1, stereo_prefetch=False, keyframe_distance=0.0, keyframe_rotation=0.0, texture_budget=None,
+                 display='window', display_every=100, snapshot_dir=None, snapshot_every=100,
+                 checkpoint_path=None, checkpoint_every=1000, data_path=DATA_PATH,
+                 stats=None, stats_file=None, stats_every=STATS_EVERY, profile_path=None, profile_interval=PROFILE_INTERVAL,
+                 precompute_scans=False):
         self.is_texture_mapping = enable_texture_mapping
         self.enable_dead_reckoning = enable_dead_reckoning
+        self.chunk_rows = chunk_rows
+        self.precompute_scans = precompute_scans
+        self.data_path = data_path
+        self.pipeline = pipeline
+
+        # Timers, counters and histograms of the stages, reported every stats_every iterations, and the stacks sampled while driving
+        self.instruments = make_instruments(stats, stats_file, every=stats_every)
+        self.profiler = SamplingProfiler(profile_path, interval=profile_interval) if profile_path else None
+
+        self.keyframes = KeyframePolicy(min_distance=keyframe_distance, min_rotation=keyframe_rotation, compute_budget=texture_budget)
 
         # Create Sensors
-        self.lidar = Lidar(param_file=LIDAR_TO_VEHICLE_PARAMETERS_PATH)
-        self.motion_sensor = DifferentialDrive(param_file=FOG_TO_VEHICLE_PARAMETERS_PATH)
-        self.stereo = Stereo(LEFT_CAMERA_CONFIG_FILE_PATH, RIGHT_CAMERA_CONFIG_FILE_PATH, STEREO_TO_VEHICLE_PARAMETERS_PATH)
+        self.lidar = Lidar(param_file=data_file(data_path, LIDAR_TO_VEHICLE_PARAMETERS_PATH), angles=LIDAR_ANGLES)
+        self.motion_sensor = DifferentialDrive(param_file=data_file(data_path, FOG_TO_VEHICLE_PARAMETERS_PATH))
+        self.stereo = Stereo(data_file(data_path, LEFT_CAMERA_CONFIG_FILE_PATH), data_file(data_path, RIGHT_CAMERA_CONFIG_FILE_PATH),
+                             data_file(data_path, STEREO_TO_VEHICLE_PARAMETERS_PATH), pixel_step=texture_step, prefetch=stereo_prefetch)
 
         # Create Particle Filter
-        self.pf = ParticleFilter(n_particles=n_particles, enable_dead_reckoning=enable_dead_reckoning)
+        self.pf = ParticleFilter(n_particles=n_particles, enable_dead_reckoning=enable_dead_reckoning, enable_scan_matching=enable_scan_matching, seed=seed,
+                                 resampling=resampling, resample_threshold=resample_threshold, temperature=temperature, tiled_map=tiled_map,
+                                 map_odds_dtype=map_odds_dtype, coarse_level=coarse_level, refine_top_k=refine_top_k,
+                                 observation_model=observation_model, n_workers=n_workers, parallel_mode=parallel_mode,
+                                 instruments=self.instruments)
 
-    def start(self):
+        # Live view of the map while driving, and snapshots of it written to disk
+        self.display_backend = display
+        self.display = DISPLAYS[display](self.pf.map, every=display_every)
+        self.snapshots = SnapshotWriter(self.pf.map, snapshot_dir, every=snapshot_every) if snapshot_dir else None
+
+        # The state is checkpointed every checkpoint_every iterations, iteration is the index of the next one
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.iteration = 0
+
+    def start(self, checkpoint=None):
         """
         This function would simulate the starting of vehicle, where all the sensors and the engine will be powered.
+        @param checkpoint: Path of a checkpoint to resume the drive from, instead of starting it from the first scan
         """
-        # Start loading the data for the sensors
-        self.lidar.load_data(LIDAR_DATA_FILE)
-        self.motion_sensor.load_data(gyro_path=FOG_DATA_FILE, encoder_data=ENCODER_DATA_FILE)
-        self.stereo.load_data(LEFT_CAMERA_DATA_PATH, RIGHT_CAMERA_DATA_PATH)
+        # Start loading the data for the sensors, streaming them in chunks if chunk_rows is set
+        self.lidar.load_data(get_sensor_file(data_file(self.data_path, LIDAR_DATA_FILE)), chunk_rows=self.chunk_rows)
+        self.motion_sensor.load_data(gyro_path=get_sensor_file(data_file(self.data_path, FOG_DATA_FILE)),
+                                     encoder_data=get_sensor_file(data_file(self.data_path, ENCODER_DATA_FILE)), chunk_rows=self.chunk_rows)
+
+        # Integrate the odometry of all the lidar intervals up front, streamed logs are integrated sample by sample instead
+        if self.chunk_rows is None:
+            self.motion_sensor.precompute(self.lidar.timestamp)
+
+            # Convert all the lidar scans to end points up front
+            if self.precompute_scans and not self.enable_dead_reckoning:
+                self.lidar.precompute()
+
+        # The stereo images are only read for the texture map, so a drive without them can be driven without texture mapping
+        if self.is_texture_mapping and not self.enable_dead_reckoning:
+            left_folder = data_file(self.data_path, LEFT_CAMERA_DATA_PATH)
+            right_folder = data_file(self.data_path, RIGHT_CAMERA_DATA_PATH)
+            if os.path.isdir(left_folder) and os.path.isdir(right_folder):
+                self.stereo.load_data(left_folder, right_folder)
+            else:
+                print("ERROR: No stereo images in {}, the texture map is disabled".format(data_file(self.data_path, IMAGES_DATA_PATH)))
+                self.is_texture_mapping = False
+
+        if checkpoint:
+            self.resume(checkpoint)
+            return
 
         # Initialise Map
         self.pf.initialise_map(self.observe())
@@ -58,40 +146,149 @@ class Vehicle:
     def drive(self):
         """
         Simulates the drive of a vehicle, where it moves and observes the World.
-        Internally, it makes use of the particle filter for SLAM as it drives
+        Internally, it makes use of the particle filter for SLAM as it drives.
+        With the pipeline, the sensors are read and the stereo frames are processed in background threads, ahead of the filter,
+        and their results are consumed in the same order as without it.
+        Only the stereo frames selected by the keyframe policy are texture mapped. Without the pipeline, the other ones are not even read,
+        with it, they are processed by the stereo stage but not projected.
+        The stages are timed by the instruments, and the sampling profiler, if any, runs for the whole drive.
         """
-        move_ts = self.motion_sensor.get_next_timestamp()
-        lidar_ts = self.lidar.get_next_timestamp()
-        stereo_ts = self.stereo.get_next_timestamp()
+        if self.profiler is not None:
+            self.profiler.start()
+        steps = self.sensor_steps()
+        frames = self.stereo_frames(lazy=not self.pipeline) if self.is_texture_mapping and not self.enable_dead_reckoning else iter(())
+        if self.pipeline:
+            steps, frames = Stage(steps), Stage(frames)
 
-        i = 0
-        while move_ts and lidar_ts:
+        try:
+            frame = next(frames, None)
+            for i, (delta_robot_pose, observation, lidar_ts, cursors) in enumerate(steps, start=self.iteration):
 
-            self.pf.predict(self.move())
+                self.pf.predict(delta_robot_pose)
 
-            if not self.enable_dead_reckoning:
-                self.pf.update(self.observe())
-                self.pf.resample()
+                if not self.enable_dead_reckoning:
+                    self.pf.update(observation)
+                    self.pf.resample()
 
-                if self.is_texture_mapping:
-                    while stereo_ts and lidar_ts and lidar_ts > stereo_ts:
-                        coord, pixel = self.stereo.read_sample()
-                        stereo_ts = self.stereo.get_next_timestamp()
-                        self.pf.texture_map(coord, pixel)
+                    # Texture the frames taken before the lidar scan
+                    while frame is not None and lidar_ts > frame[0]:
+                        self.texture_frame(*frame[:3])
+                        frame = next(frames, None)
 
-                if i % 100 == 0:
-                    self.pf.map.display_map()
+                    self.display.update(i)
+
+                if self.snapshots is not None:
+                    self.snapshots.update(i)
+                self.instruments.report(i)
+
+                # The sensors may be read ahead of the filter, so the cursors are the ones of the step and of the next frame
+                self.iteration = i + 1
+                if self.checkpoint_path and self.iteration % self.checkpoint_every == 0:
+                    self.save_checkpoint(cursors, self.stereo.current_index if frame is None else frame[3])
+        finally:
+            if self.pipeline:
+                steps.close()
+                frames.close()
+            if self.profiler is not None:
+                self.profiler.stop()
+
+    def sensor_steps(self):
+        """
+        Reads the motion and the lidar scan of every step of the drive. They do not depend on the filter, so they can be read ahead of it.
+        @return: Iterator of (delta pose, lidar end points in the robot frame or None with dead reckoning, next lidar timestamp,
+                 sensor cursors after the step)
+        """
+        move_ts = self.motion_sensor.get_next_timestamp()
+        lidar_ts = self.lidar.get_next_timestamp()
+        while move_ts and lidar_ts:
+            with self.instruments.timer('move'):
+                delta_robot_pose = self.move()
+            if not self.enable_dead_reckoning:
+                observation = self.observe()
             else:
-                lidar_data = self.lidar.read_sample()
+                observation = None
+                self.lidar.read_sample()
+            yield delta_robot_pose, observation, lidar_ts, self.sensor_cursors()
 
             move_ts = self.motion_sensor.get_next_timestamp()
             lidar_ts = self.lidar.get_next_timestamp()
-            i += 1
+
+    def stereo_frames(self, lazy=False):
+        """
+        Computes the body frame coordinates of the stereo frames
+        @param lazy: Leave the frames unread, the consumer reads or skips each one before asking for the next, see texture_frame
+        @return: Iterator of (next stereo timestamp, coordinates, pixel values, index of the frame), coordinates and pixel values are None if lazy
+        """
+        stereo_ts = self.stereo.get_next_timestamp()
+        while stereo_ts:
+            index = self.stereo.current_index
+            if lazy:
+                yield stereo_ts, None, None, index
+            else:
+                coord, pixel = self.stereo.read_sample()
+                yield stereo_ts, coord, pixel, index
+            stereo_ts = self.stereo.get_next_timestamp()
+
+    def sensor_cursors(self):
+        """
+        @return: Indices of the next lidar, gyro and encoder samples
+        """
+        return np.array([self.lidar.current_index, self.motion_sensor.gyro_index, self.motion_sensor.encoder_current_index])
+
+    def save_checkpoint(self, cursors, stereo_index):
+        """
+        Writes the state of the filter, of the map and of the sensors to checkpoint_path
+        @param cursors: Sensor cursors of the last step processed by the filter, see sensor_cursors
+        @param stereo_index: Index of the next stereo frame to texture map
+        """
+        state = self.pf.state()
+        state.update(self.keyframes.state())
+        state['iteration'] = np.array(self.iteration)
+        state['sensor_cursors'] = cursors
+        state['stereo_index'] = np.array(stereo_index)
+        save_checkpoint(self.checkpoint_path, state)
+
+    def resume(self, checkpoint):
+        """
+        Restores the state saved by save_checkpoint, the sensor logs must be loaded
+        @param checkpoint: Path of the checkpoint
+        """
+        state = load_checkpoint(checkpoint)
+        self.pf.restore(state)
+        self.keyframes.restore(state)
+        self.iteration = int(state['iteration'])
+        lidar_index, gyro_index, encoder_index = state['sensor_cursors']
+        self.lidar.seek(int(lidar_index))
+        self.motion_sensor.seek(int(encoder_index), int(gyro_index))
+        self.stereo.seek(int(state['stereo_index']))
+
+    def texture_frame(self, stereo_ts, coord, pixel):
+        """
+        Texture maps a stereo frame if it is a keyframe
+        @param stereo_ts: Timestamp of the frame
+        @param coord: Body frame coordinates, None if the frame has not been read yet
+        @param pixel: Pixel values
+        """
+        best_pose = self.pf.particles.best_pose
+        if not self.keyframes.is_keyframe(stereo_ts, best_pose):
+            if coord is None:
+                self.stereo.skip_sample()
+            return
+
+        with self.instruments.timer('texture'):
+            start = time.perf_counter()
+            if coord is None:
+                coord, pixel = self.stereo.read_sample()
+            self.pf.texture_map(coord, pixel)
+            self.keyframes.add_keyframe(best_pose, time.perf_counter() - start)
 
     def move(self):
         """
         Gets the delta change in pose from differential drive. Internal this is synced with the lidar observation timestamp. So, we collect the data until we have a lidar observation
         """
+        if self.motion_sensor.odometry_encoder_index is not None:
+            return self.motion_sensor.read_interval(self.lidar.current_index)
+
         # Motion
         d_robot_pose = np.array([0.0, 0.0])
         move_ts = self.motion_sensor.get_next_timestamp()
@@ -107,14 +304,28 @@ class Vehicle:
         @return: The end Coordinates detected by Lidar
 
         This function collects the next scan from the lidar and converts them to cartesian. And returns this coordinates in the Robot Frame
+        The beams are converted with their precomputed directions in the body frame, or served from the pre-converted log.
         """
-        lidar_data = self.lidar.read_sample()
-        angles, ranges = get_valid(LIDAR_ANGLES, lidar_data)
-        coord = convert_angle_coord(angles, ranges)
-        s_b = self.lidar.convert_to_body_frame(coord)
+        with self.instruments.timer('observe'):
+            s_b = self.lidar.read_scan()
+        self.instruments.observe('scan_size', s_b.shape[0])
         return s_b
 
+    def stop(self):
+        """
+        This function would simulate turning the vehicle off, the workers of the particle filter and the stereo prefetcher are stopped,
+        and the last snapshot and statistics are written.
+        """
+        self.instruments.close()
+        self.pf.close()
+        self.stereo.stop_prefetch()
+        self.display.close()
+        if self.snapshots is not None:
+            self.snapshots.close()
+
     def show_map(self):
+        if self.display_backend == 'none':
+            return
         if self.enable_dead_reckoning:
             self.pf.map.show_robot_path()
         else:
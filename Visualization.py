@@ -0,0 +1,215 @@
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+# Number of snapshots waiting to be written before the drive waits for the writer
+SNAPSHOT_QUEUE_SIZE = 2
+
+
+def close_window(name):
+    """
+    Destroys a window that was shown, an error of the GUI backend is only reported
+    """
+    try:
+        cv2.destroyWindow(name)
+    except cv2.error as error:
+        print("ERROR: Cannot close the window {}: {}".format(name, error))
+
+
+class MapCanvas:
+    def __init__(self, grid_map, grid_name):
+        """
+        Dense image of a grid of the map. Only the cells changed since the last render are copied again, unless a tiled map grew.
+        @param grid_map: Map
+        @param grid_name: 'probability' or 'texture_map'
+        """
+        self.map = grid_map
+        self.grid_name = grid_name
+        self.watcher = 'canvas_{}_{}'.format(grid_name, id(self))
+        grid_map.watch(self.watcher, 'texture_map' if grid_name == 'texture_map' else 'map')
+        self.image = None
+        self.bounds = None
+
+    def _crop(self, grid, x0, y0, x1, y1):
+        if self.map.tiled:
+            return grid.crop(x0, y0, x1, y1)
+        return grid[x0:x1, y0:y1]
+
+    def render(self):
+        """
+        @return: The image, None if the grid does not exist yet
+        """
+        grid = getattr(self.map, self.grid_name)
+        dirty = self.map.take_dirty(self.watcher)
+        if grid is None:
+            return None
+
+        bounds = self.map.grid_bounds(grid)
+        if self.image is None or bounds != self.bounds:
+            self.image = np.array(self._crop(grid, *bounds))
+            self.bounds = bounds
+        elif dirty is not None:
+            x0, y0 = max(dirty[0], bounds[0]), max(dirty[1], bounds[1])
+            x1, y1 = min(dirty[2], bounds[2]), min(dirty[3], bounds[3])
+            if x0 < x1 and y0 < y1:
+                self.image[x0 - bounds[0]:x1 - bounds[0], y0 - bounds[1]:y1 - bounds[1]] = self._crop(grid, x0, y0, x1, y1)
+        return self.image
+
+
+class Display:
+    def __init__(self, grid_map, every=100):
+        """
+        Visualization backend that renders the map every few iterations of the drive. This one renders nothing, for headless runs.
+        @param grid_map: Map
+        @param every: Number of iterations between two renders
+        """
+        self.map = grid_map
+        self.every = every
+
+    def update(self, iteration):
+        if iteration % self.every == 0:
+            self.render(iteration)
+
+    def render(self, iteration):
+        pass
+
+    def close(self):
+        pass
+
+
+class WindowDisplay(Display):
+    def __init__(self, grid_map, every=100):
+        """
+        Shows the occupancy image in a window that stays open, without waiting for a key. The window is only created by the first render,
+        and nothing is shown if opencv has no GUI support.
+        """
+        super().__init__(grid_map, every)
+        self.name = "Occupancy Map"
+        self.canvas = MapCanvas(grid_map, 'probability')
+        self.window_open = False
+        self.failed = False
+
+    def render(self, iteration):
+        if self.failed:
+            return
+        try:
+            cv2.imshow(self.name, self.canvas.render())
+            self.window_open = True
+            cv2.waitKey(1)
+        except cv2.error as error:
+            print("ERROR: Cannot show the map, the drive goes on without it: {}".format(error))
+            self.failed = True
+
+    def close(self):
+        if self.window_open:
+            close_window(self.name)
+            self.window_open = False
+
+
+class ThreadedDisplay(Display):
+    def __init__(self, grid_map, every=100):
+        """
+        Shows the occupancy image from a background thread. The drive only copies the changed cells into the canvas and hands
+        a copy of it to the thread, which always shows the latest one.
+        """
+        super().__init__(grid_map, every)
+        self.name = "Occupancy Map"
+        self.canvas = MapCanvas(grid_map, 'probability')
+        self.latest = None
+        self.window_open = False
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                if self.ready.wait(timeout=0.05):
+                    self.ready.clear()
+                    cv2.imshow(self.name, self.latest)
+                    self.window_open = True
+                if self.window_open:
+                    cv2.waitKey(1)
+        except cv2.error as error:
+            print("ERROR: Cannot show the map, the drive goes on without it: {}".format(error))
+        if self.window_open:
+            close_window(self.name)
+            self.window_open = False
+
+    def render(self, iteration):
+        self.latest = self.canvas.render().copy()
+        self.ready.set()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class SnapshotWriter(Display):
+    def __init__(self, grid_map, directory, every=100):
+        """
+        Writes snapshots of the occupancy and texture images and of the trajectory to a directory from a background thread.
+        Every file is written to a temporary name first and then renamed, so a snapshot is either complete or missing.
+        @param directory: Directory of the snapshots, created if needed
+        """
+        super().__init__(grid_map, every)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.occupancy = MapCanvas(grid_map, 'probability')
+        self.texture = MapCanvas(grid_map, 'texture_map')
+        self.queue = queue.Queue(maxsize=SNAPSHOT_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _path(self, name, label, extension):
+        return os.path.join(self.directory, '{}_{}{}'.format(name, label, extension))
+
+    def _write(self, path, write):
+        root, extension = os.path.splitext(path)
+        temporary = root + '.tmp' + extension
+        write(temporary)
+        os.replace(temporary, path)
+
+    def _run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                return
+            label, occupancy, texture, trajectory = snapshot
+            try:
+                self._write(self._path('occupancy', label, '.png'), lambda path: cv2.imwrite(path, occupancy))
+                if texture is not None:
+                    self._write(self._path('texture', label, '.png'), lambda path: cv2.imwrite(path, texture))
+                self._write(self._path('trajectory', label, '.npy'), lambda path: np.save(path, trajectory))
+            except (OSError, cv2.error) as error:
+                print("ERROR: Could not write the snapshot " + label + ": " + str(error))
+
+    def render(self, iteration):
+        self.snapshot('{:06d}'.format(iteration))
+
+    def snapshot(self, label):
+        """
+        Queues a snapshot of the current map
+        @param label: Label of the files of the snapshot
+        """
+        texture = self.texture.render()
+        self.queue.put((label, self.occupancy.render().copy(), None if texture is None else texture.copy(), np.array(self.map.robot_coord)))
+
+    def close(self):
+        """
+        Writes a last snapshot, labelled 'final', and waits for the writer
+        """
+        self.snapshot('final')
+        self.queue.put(None)
+        self.thread.join()
+
+
+DISPLAYS = {
+    'none': Display,
+    'window': WindowDisplay,
+    'thread': ThreadedDisplay,
+}
@@ -0,0 +1,211 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from Instrumentation import Profiler
+from MotionModel import MOTION_SIGMAS
+from ParticleFilter import ParticleFilter
+from Vehicle import DATA_PATH, Vehicle
+
+# Drive of a process worker, attached once by _init_worker
+_worker = {}
+
+
+def preprocess(data_path):
+    """
+    Reads the sensor logs of a drive once, and turns them into the inputs of the filter at every step, exactly as Vehicle.drive
+    would feed them without texture mapping
+    @param data_path: Data directory of the drive
+    @return: Dict of arrays, 'deltas' (S, 2) odometry of the steps, 'scans' (S + 1,) index of the lidar scan of the initial map and
+             of every step, 'timestamps' (S + 1,) their timestamps, and the end points of all the scans, see Lidar.precompute
+    """
+    vehicle = Vehicle(n_particles=1, display='none', data_path=data_path, precompute_scans=True)
+    vehicle.start()
+
+    deltas, scans = [], [0]
+    for delta_robot_pose, _, _, _ in vehicle.sensor_steps():
+        deltas.append(delta_robot_pose)
+        scans.append(vehicle.lidar.current_index - 1)
+    vehicle.stop()
+
+    scans = np.array(scans)
+    return {
+        'deltas': np.array(deltas, dtype=np.float64).reshape(-1, 2),
+        'scans': scans,
+        'timestamps': np.asarray(vehicle.lidar.timestamp, dtype=np.int64)[scans],
+        'points': vehicle.lidar.points,
+        'offsets': vehicle.lidar.offsets,
+    }
+
+
+def share(arrays):
+    """
+    Copies arrays to new shared memory blocks
+    @param arrays: Dict of name -> array
+    @return: List of the shared memory blocks, and dict of name -> (shared memory name, shape, dtype) to attach them
+    """
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        blocks.append(shm)
+        specs[name] = (shm.name, array.shape, array.dtype)
+    return blocks, specs
+
+
+def _init_worker(specs):
+    """
+    Attaches a process worker to the shared drive, as read-only arrays
+    @param specs: Dict of name -> (shared memory name, shape, dtype), see share
+    """
+    _worker['shm'] = []
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        _worker['shm'].append(shm)
+        _worker[name] = array
+
+
+def run_filter(name, config, output):
+    """
+    Runs a particle filter over the shared drive and writes its occupancy image and its trajectory to output/name
+    @param name: Name of the run
+    @param config: Keyword arguments of ParticleFilter
+    @param output: Results directory
+    @return: Dict of the config and of the timing of the run
+    """
+    deltas, scans, points, offsets = _worker['deltas'], _worker['scans'], _worker['points'], _worker['offsets']
+    instruments = Profiler()
+    pf = ParticleFilter(instruments=instruments, **config)
+
+    start = time.perf_counter()
+    pf.initialise_map(points[offsets[scans[0]]:offsets[scans[0] + 1]])
+    trajectory = np.zeros((deltas.shape[0], 3))
+    for i in range(deltas.shape[0]):
+        scan = scans[i + 1]
+        pf.predict(deltas[i])
+        pf.update(points[offsets[scan]:offsets[scan + 1]])
+        pf.resample()
+        trajectory[i] = pf.particles.best_pose
+    elapsed = time.perf_counter() - start
+
+    directory = os.path.join(output, name)
+    os.makedirs(directory, exist_ok=True)
+    cv2.imwrite(os.path.join(directory, 'occupancy.png'), pf.map.dense(pf.map.probability))
+    np.savetxt(os.path.join(directory, 'trajectory.csv'), np.column_stack((_worker['timestamps'][1:], trajectory)),
+               delimiter=',', fmt=['%d', '%.6f', '%.6f', '%.6f'])
+    pf.close()
+
+    stats = instruments.stats()
+    return {
+        'name': name,
+        'config': config,
+        'steps': int(deltas.shape[0]),
+        'elapsed_s': elapsed,
+        'steps_per_s': deltas.shape[0] / elapsed if elapsed > 0 else 0.0,
+        'final_pose': trajectory[-1].tolist() if deltas.shape[0] else None,
+        'timers': stats['timers'],
+        'resamples': stats['counters'].get('resamples', 0),
+    }
+
+
+def trajectory_error(result, output, ground_truth):
+    """
+    Adds the position error of a run against the ground truth to its result
+    @param ground_truth: (T,) timestamps and (T, 2) positions
+    """
+    trajectory_file = os.path.join(output, result['name'], 'trajectory.csv')
+    timestamps = np.loadtxt(trajectory_file, delimiter=',', usecols=0, dtype=np.int64, ndmin=1)
+    positions = np.loadtxt(trajectory_file, delimiter=',', usecols=(1, 2), ndmin=2)
+    _, in_trajectory, in_truth = np.intersect1d(timestamps, ground_truth[0], return_indices=True)
+    if in_trajectory.shape[0] == 0:
+        return
+    error = np.hypot(*(positions[in_trajectory] - ground_truth[1][in_truth]).T)
+    result['mean_error'] = float(np.mean(error))
+    result['final_error'] = float(error[-1])
+
+
+def run_batch(data_path, configs, output, n_workers):
+    """
+    Preprocesses the drive once and runs every config on a pool of processes sharing it. The results of all the runs are written
+    to output/results.json, next to one directory per run.
+    @param data_path: Data directory of the drive
+    @param configs: List of keyword arguments of ParticleFilter
+    @param output: Results directory
+    @param n_workers: Number of processes
+    @return: List of the results
+    """
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    drive = preprocess(data_path)
+    print("Preprocessed {} steps in {:.1f} s".format(drive['deltas'].shape[0], time.perf_counter() - start))
+
+    blocks, specs = share(drive)
+    try:
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(specs,)) as pool:
+            futures = [pool.submit(run_filter, 'run_{:03d}'.format(i), config, output) for i, config in enumerate(configs)]
+            results = []
+            for future in futures:
+                result = future.result()
+                print("{}: {:.1f} s, {:.1f} steps/s, {}".format(result['name'], result['elapsed_s'], result['steps_per_s'], result['config']))
+                results.append(result)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    ground_truth_file = os.path.join(data_path, 'ground_truth.csv')
+    if os.path.isfile(ground_truth_file):
+        ground_truth = (np.loadtxt(ground_truth_file, delimiter=',', usecols=0, dtype=np.int64, ndmin=1),
+                        np.loadtxt(ground_truth_file, delimiter=',', usecols=(1, 2), ndmin=2))
+        for result in results:
+            trajectory_error(result, output, ground_truth)
+
+    with open(os.path.join(output, 'results.json'), 'w') as f:
+        json.dump({'data_path': data_path, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'runs': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs many particle filter configurations over the same drive in parallel')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Results directory, with one directory per run and results.json')
+    parser.add_argument('--data-path', type=str, default=DATA_PATH,
+                        help='Data directory of the drive, laid out like data (default: data)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of runs in parallel (default: number of cpus)')
+    parser.add_argument('--particles', type=int, nargs='+', default=[20],
+                        help='Particle counts of the sweep (default: 20)')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0],
+                        help='Seeds of the sweep (default: 0)')
+    parser.add_argument('--motion-sigmas', type=str, nargs='+', default=[','.join(str(sigma) for sigma in MOTION_SIGMAS)],
+                        help='Motion noise sigmas of the sweep, as comma separated x,y,theta (default: {})'.format(
+                            ','.join(str(sigma) for sigma in MOTION_SIGMAS)))
+    parser.add_argument('--resampling', choices=['systematic', 'stratified', 'residual'], default='stratified',
+                        help='Resampling scheme of all the runs (default: stratified)')
+    parser.add_argument('--observation-model', choices=['hits', 'likelihood'], default='hits',
+                        help='Observation model of all the runs (default: hits)')
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help='Temperature of all the runs (default: 1.0)')
+
+    parameters = parser.parse_args()
+
+    configs = []
+    for n_particles, seed, sigmas in itertools.product(parameters.particles, parameters.seeds, parameters.motion_sigmas):
+        configs.append({
+            'n_particles': n_particles,
+            'seed': seed,
+            'motion_sigmas': [float(sigma) for sigma in sigmas.split(',')],
+            'resampling': parameters.resampling,
+            'observation_model': parameters.observation_model,
+            'temperature': parameters.temperature,
+        })
+    run_batch(parameters.data_path, configs, parameters.output, parameters.workers)
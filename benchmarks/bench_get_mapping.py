@@ -0,0 +1,72 @@
+"""
+Benchmark of the batched ray tracing in trace_free against the per-beam bresenham2D loop.
+
+Run from the home directory of the project:
+    $ python -m benchmarks.bench_get_mapping
+"""
+import argparse
+import time
+
+import numpy as np
+
+from Sensors.sensor_utils import bresenham2D, trace_free
+
+LIDAR_ANGLES = np.linspace(-5, 185, 286) / 180 * np.pi
+
+
+def trace_free_per_beam(bot_pos, points):
+    """
+    Reference implementation, traces one beam at a time with bresenham2D
+    @return: (N, 2) free cells of all the beams
+    """
+    free_points = [bresenham2D(bot_pos[0], bot_pos[1], p[0], p[1]).T[:-1, :] for p in points]
+    return np.concatenate(free_points).astype(np.int64)
+
+
+def trace_free_cells(bot_pos, points):
+    """
+    @return: (N, 2) free cells of all the beams traced by trace_free
+    """
+    return np.stack(trace_free(bot_pos, points), axis=1)
+
+
+def make_scan(max_range, res, rng):
+    """
+    Lidar end points in grid cells for a robot sitting at the origin
+    @param max_range: maximum range of the beams in meters
+    @param res: grid resolution in meters per cell
+    @param rng: numpy random generator
+    @return: (286, 2) end points
+    """
+    ranges = rng.uniform(0.1, max_range, LIDAR_ANGLES.shape[0])
+    points = np.stack((ranges * np.cos(LIDAR_ANGLES), ranges * np.sin(LIDAR_ANGLES)), axis=1)
+    return np.ceil(points / res).astype(int)
+
+
+def time_it(func, *args, repeat=20):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the ray tracing in trace_free')
+    parser.add_argument('--res', type=float, default=4,
+                        help='Grid resolution in meters, the Map uses 4 (default: 4)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of timed runs, the best one is reported (default: 20)')
+    parameters = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    start_point = np.zeros(2, dtype=int)
+    print("{:>10} {:>12} {:>12} {:>10}".format("range (m)", "loop (ms)", "batch (ms)", "speedup"))
+    for max_range in [10, 20, 30, 40]:
+        end_points = make_scan(max_range, parameters.res, rng)
+        assert np.array_equal(trace_free_per_beam(start_point, end_points), trace_free_cells(start_point, end_points))
+
+        loop_time = time_it(trace_free_per_beam, start_point, end_points, repeat=parameters.repeat)
+        batch_time = time_it(trace_free_cells, start_point, end_points, repeat=parameters.repeat)
+        print("{:>10} {:>12.3f} {:>12.3f} {:>9.1f}x".format(max_range, loop_time * 1e3, batch_time * 1e3, loop_time / batch_time))
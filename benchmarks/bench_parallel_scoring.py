@@ -0,0 +1,80 @@
+"""
+Benchmark of the parallel particle scoring against the number of workers, for both observation models.
+
+Run from the home directory of the project:
+    $ python -m benchmarks.bench_parallel_scoring
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from Map import Map
+from ParallelScoring import PARALLEL_MODES, ParallelScorer
+
+LIDAR_ANGLES = np.linspace(-5, 185, 286) / 180 * np.pi
+
+
+def add_scans(grid_map, n_scans, rng):
+    """
+    Updates a map with random scans around the origin
+    @param n_scans: Number of scans
+    @param rng: numpy random generator
+    """
+    for _ in range(n_scans):
+        center = rng.uniform(-200, 200, 2)
+        grid_map.update_free(center, center + rng.normal(0, 60, (LIDAR_ANGLES.shape[0], 2)))
+
+
+def make_scan(max_range, rng):
+    """
+    @return: (286, 2) lidar end points in the robot frame
+    """
+    ranges = rng.uniform(0.1, max_range, LIDAR_ANGLES.shape[0])
+    return np.stack((ranges * np.cos(LIDAR_ANGLES), ranges * np.sin(LIDAR_ANGLES)), axis=1)
+
+
+def time_it(func, *args, repeat=5):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the parallel particle scoring')
+    parser.add_argument('--particles', type=int, default=100000,
+                        help='Number of particles scored (default: 100000)')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count(),
+                        help='Largest number of workers, the workers double from 1 up to it (default: number of cores)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed runs, the best one is reported (default: 5)')
+    parameters = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    grid_map = Map(likelihood_field=True)
+    add_scans(grid_map, 20, rng)
+    scan = make_scan(80, rng)
+    poses = np.column_stack((rng.uniform(-100, 100, (parameters.particles, 2)), rng.uniform(-np.pi, np.pi, parameters.particles)))
+
+    workers = [1 << i for i in range(int(np.log2(max(parameters.max_workers, 1))) + 1)]
+    for model in ['hits', 'likelihood']:
+        serial_time = time_it(grid_map.map_correlation_batch, poses, scan, 0, model, repeat=parameters.repeat)
+        print("{} particles, {} model, serial {:.3f} ms".format(parameters.particles, model, serial_time * 1e3))
+        print("{:>8} {:>8} {:>12} {:>10}".format("mode", "workers", "time (ms)", "speedup"))
+        for mode in PARALLEL_MODES:
+            for n_workers in workers:
+                scorer = ParallelScorer(grid_map, parameters.particles, n_workers, mode=mode)
+                assert np.array_equal(scorer.map_correlation_batch(poses, scan, model=model),
+                                      grid_map.map_correlation_batch(poses, scan, model=model))
+
+                # The updates of the map after the workers started are seen by them
+                add_scans(grid_map, 1, rng)
+                assert np.array_equal(scorer.map_correlation_batch(poses, scan, model=model),
+                                      grid_map.map_correlation_batch(poses, scan, model=model))
+                parallel_time = time_it(scorer.map_correlation_batch, poses, scan, model, repeat=parameters.repeat)
+                scorer.close()
+                print("{:>8} {:>8} {:>12.3f} {:>9.2f}x".format(mode, n_workers, parallel_time * 1e3, serial_time / parallel_time))
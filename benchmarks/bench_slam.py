@@ -0,0 +1,235 @@
+"""
+Benchmark of the SLAM hot paths on a synthetic drive: lidar conversion, ray tracing and map update, map correlation, scan matching,
+motion prediction, resampling, stereo processing and the whole drive. It reports the latency and the throughput of every stage across particle counts and map sizes,
+and writes them to a JSON file so they can be compared between runs.
+
+Run from the home directory of the project:
+    $ python -m benchmarks.bench_slam --output=bench_slam.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+from Map import Map
+from MotionModel import MotionModel
+from Sensors.SensorStream import STREAM_CHUNK_ROWS
+from Vehicle import Vehicle
+from benchmarks.synthetic import generate_drive
+from resampling import RESAMPLERS
+
+# The generated lidar starts after the odometry, so the odometry before the first lidar interval is checked as well
+LIDAR_DELAY = 1.0
+# The median final position error of a few seeds must stay within a fraction of the distance driven, and at least two cells of the map
+ACCURACY_SEEDS = [0, 1, 2]
+ACCURACY_FRACTION = 0.25
+ACCURACY_MIN_BOUND = 8.0
+
+
+def measure(func, repeat):
+    """
+    @param func: Function called without arguments
+    @param repeat: Number of timed calls
+    @return: (repeat,) latencies in seconds
+    """
+    latencies = np.zeros(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+
+def record(results, stage, latencies, items, **config):
+    """
+    Adds the statistics of a stage to the results and prints them
+    @param items: Number of items processed by a call, e.g. particles, for the throughput
+    @param config: Parameters of the run, e.g. particles or map_size
+    """
+    result = dict(stage=stage, **config,
+                  calls=int(latencies.shape[0]),
+                  mean_ms=float(np.mean(latencies) * 1e3),
+                  p50_ms=float(np.percentile(latencies, 50) * 1e3),
+                  p95_ms=float(np.percentile(latencies, 95) * 1e3),
+                  throughput=float(items / np.mean(latencies)))
+    results.append(result)
+    config = ' '.join('{}={}'.format(key, value) for key, value in config.items())
+    print("{:<22} {:<28} {:>10.3f} {:>10.3f} {:>10.3f} {:>14.1f}".format(stage, config, result['mean_ms'], result['p50_ms'],
+                                                                           result['p95_ms'], result['throughput']))
+
+
+def load_scans(vehicle, n_scans):
+    """
+    @return: List of lidar end points in the robot frame of the first scans of the drive
+    """
+    vehicle.lidar.load_data(os.path.join(vehicle.data_path, 'sensor_data', 'lidar.csv'))
+    return [vehicle.lidar.read_scan() for _ in range(n_scans)]
+
+
+def check_odometry(data_path):
+    """
+    Checks that the precomputed odometry gives the same steps as the sample by sample integration of a streamed drive,
+    including the first step, which also covers the odometry before the first lidar interval
+    """
+    steps = []
+    for chunk_rows in [None, STREAM_CHUNK_ROWS]:
+        vehicle = Vehicle(display='none', data_path=data_path, chunk_rows=chunk_rows)
+        vehicle.start()
+        steps.append(np.array([delta_robot_pose for delta_robot_pose, _, _, _ in vehicle.sensor_steps()]))
+        vehicle.stop()
+    assert steps[0].shape == steps[1].shape and np.allclose(steps[0], steps[1])
+
+
+def check_accuracy(data_path, n_particles=50):
+    """
+    Checks that the filter follows the ground truth of a synthetic drive, with and without scan matching. A single seed can lose the
+    track, so the median of the final position errors of a few seeds is checked.
+    """
+    ground_truth_file = os.path.join(data_path, 'ground_truth.csv')
+    if not os.path.isfile(ground_truth_file):
+        return
+    timestamps = np.loadtxt(ground_truth_file, delimiter=',', usecols=0, dtype=np.int64, ndmin=1)
+    positions = np.loadtxt(ground_truth_file, delimiter=',', usecols=(1, 2), ndmin=2)
+    bound = max(ACCURACY_MIN_BOUND, ACCURACY_FRACTION * np.sum(np.hypot(*np.diff(positions, axis=0).T)))
+
+    for enable_scan_matching in [False, True]:
+        errors = []
+        for seed in ACCURACY_SEEDS:
+            vehicle = Vehicle(n_particles, enable_scan_matching=enable_scan_matching, seed=seed, display='none', data_path=data_path)
+            vehicle.start()
+            vehicle.drive()
+            vehicle.stop()
+            truth = positions[np.searchsorted(timestamps, vehicle.lidar.timestamp[vehicle.lidar.current_index - 1])]
+            errors.append(float(np.hypot(*(vehicle.pf.particles.best_pose[:2] - truth))))
+        print("Final position errors{}: {} m".format(' with scan matching' if enable_scan_matching else '',
+                                                      ', '.join('{:.1f}'.format(error) for error in errors)))
+        assert np.median(errors) < bound
+
+
+def bench_lidar(results, lidar, repeat):
+    record(results, 'lidar_convert', measure(lambda: lidar.convert(lidar.data[0]), repeat), 1)
+    n_scans = lidar.data.shape[0]
+    record(results, 'lidar_precompute', measure(lidar.precompute, max(1, repeat // 10)), n_scans, scans=n_scans)
+
+
+def bench_map(results, scans, map_sizes, particle_counts, repeat, rng):
+    for map_size in map_sizes:
+        grid_map = Map(x_min=-map_size, y_min=-map_size, x_max=map_size, y_max=map_size)
+        scan_index = iter(range(repeat * len(scans)))
+
+        def update():
+            scan = scans[next(scan_index) % len(scans)]
+            grid_map.update_free(np.zeros(2), scan[:, :2])
+
+        record(results, 'map_update', measure(update, repeat), 1, map_size=map_size)
+        for n_particles in particle_counts:
+            poses = np.column_stack((rng.normal(0, 2, (n_particles, 2)), rng.normal(0, 0.1, n_particles)))
+            latencies = measure(lambda: grid_map.map_correlation_batch(poses, scans[0][:, :2]), repeat)
+            record(results, 'map_correlation', latencies, n_particles, map_size=map_size, particles=n_particles)
+
+
+def bench_scan_match(results, scans, n_particles, repeat, rng):
+    poses = np.column_stack((rng.normal(0, 2, (n_particles, 2)), rng.normal(0, 0.1, n_particles)))
+
+    # On a flat score surface all the candidates tie, and the poses must stay where they are
+    for model in ['hits', 'likelihood']:
+        flat_map = Map(likelihood_field=model == 'likelihood')
+        assert np.array_equal(flat_map.scan_match(poses, scans[0][:, :2], model=model)[0], poses)
+
+    grid_map = Map()
+    for scan in scans:
+        grid_map.update_free(np.zeros(2), scan[:, :2])
+    record(results, 'scan_match', measure(lambda: grid_map.scan_match(poses, scans[0][:, :2]), repeat), n_particles, particles=n_particles)
+
+
+def bench_filter(results, particle_counts, repeat, rng):
+    for n_particles in particle_counts:
+        motion_model = MotionModel(n_particles, rng=rng)
+        poses = np.zeros((n_particles, 3))
+        record(results, 'predict', measure(lambda: motion_model.predict(poses, np.array([0.5, 0.01])), repeat), n_particles,
+               particles=n_particles)
+
+        weights = rng.random(n_particles)
+        weights /= weights.sum()
+        for name, resampler in RESAMPLERS.items():
+            record(results, 'resample_' + name, measure(lambda: resampler(weights, n_particles, rng), repeat), n_particles,
+                   particles=n_particles)
+
+
+def bench_stereo(results, vehicle, repeat):
+    vehicle.stereo.load_data(os.path.join(vehicle.data_path, 'stereo_images', 'stereo_left'),
+                             os.path.join(vehicle.data_path, 'stereo_images', 'stereo_right'))
+    repeat = min(repeat, vehicle.stereo.timestamp.shape[0])
+    record(results, 'stereo', measure(vehicle.stereo.read_sample, repeat), 1, pixel_step=vehicle.stereo.pixel_step)
+
+
+def bench_drive(results, data_path, particle_counts):
+    for n_particles in particle_counts:
+        vehicle = Vehicle(n_particles=n_particles, seed=0, display='none', data_path=data_path)
+        vehicle.start()
+        start = time.perf_counter()
+        vehicle.drive()
+        elapsed = time.perf_counter() - start
+        vehicle.stop()
+        steps = vehicle.iteration
+        record(results, 'drive', np.full(steps, elapsed / max(steps, 1)), 1, particles=n_particles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the SLAM hot paths on a synthetic drive')
+    parser.add_argument('--data-path', type=str, default=None,
+                        help='Synthetic drive to run on, generated in a temporary directory if not set (default: None)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Length of the generated drive in seconds (default: 10)')
+    parser.add_argument('--particles', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Particle counts (default: 100 1000 10000)')
+    parser.add_argument('--map-sizes', type=int, nargs='+', default=[1000, 4000],
+                        help='Half sides of the maps in meters (default: 1000 4000)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of timed calls of every stage (default: 20)')
+    parser.add_argument('--stereo', type=bool, default=False,
+                        help='Also benchmark the stereo processing, the generated drive then has stereo images (default: False)')
+    parser.add_argument('--drive', type=bool, default=True,
+                        help='Also time whole drives for every particle count (default: True)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file the results are written to (default: None)')
+    parameters = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        data_path = parameters.data_path
+        if data_path is None:
+            data_path = temporary
+            print("Generating a {:.0f} s synthetic drive".format(parameters.duration))
+            ground_truth = generate_drive(data_path, duration=parameters.duration, stereo=parameters.stereo, lidar_delay=LIDAR_DELAY)
+            np.savetxt(os.path.join(data_path, 'ground_truth.csv'), ground_truth, delimiter=',', fmt=['%d', '%.6f', '%.6f', '%.6f'])
+
+        check_odometry(data_path)
+        check_accuracy(data_path)
+        rng = np.random.default_rng(0)
+        results = []
+        vehicle = Vehicle(display='none', data_path=data_path)
+        print("{:<22} {:<28} {:>10} {:>10} {:>10} {:>14}".format("stage", "config", "mean (ms)", "p50 (ms)", "p95 (ms)", "items/s"))
+        scans = load_scans(vehicle, parameters.repeat)
+        bench_lidar(results, vehicle.lidar, parameters.repeat)
+        bench_map(results, scans, parameters.map_sizes, parameters.particles, parameters.repeat, rng)
+        bench_scan_match(results, scans, min(parameters.particles), parameters.repeat, rng)
+        bench_filter(results, parameters.particles, parameters.repeat, rng)
+        if parameters.stereo:
+            bench_stereo(results, vehicle, parameters.repeat)
+        if parameters.drive:
+            bench_drive(results, data_path, parameters.particles)
+
+    if parameters.output:
+        with open(parameters.output, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'cpus': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
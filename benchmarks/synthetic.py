@@ -0,0 +1,194 @@
+"""
+Synthetic world and drive log generator. It writes the sensor logs, stereo images and parameters in the layout of ``data``,
+so ``Vehicle.start`` can run on them without the external dataset.
+
+Run from the home directory of the project:
+    $ python -m benchmarks.synthetic --output=/tmp/synthetic_drive --duration=60
+"""
+import argparse
+import os
+import zipfile
+
+import cv2
+import numpy as np
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAM_ZIP = os.path.join(PROJECT_PATH, 'data', 'param.zip')
+
+LIDAR_ANGLES = np.linspace(-5, 185, 286) / 180 * np.pi
+LIDAR_MAX_RANGE = 80
+LIDAR_TO_VEHICLE_ROTATION = np.array([[0.00130201, 0.796097, 0.605167],
+                                      [0.999999, -0.000419027, -0.00160026],
+                                      [-0.00102038, 0.605169, -0.796097]])
+
+LEFT_WHEEL_DIAMETER = 0.623479
+RIGHT_WHEEL_DIAMETER = 0.622806
+WHEEL_BASE = 1.52439
+ENCODER_RESOLUTION = 4096
+
+START_TIMESTAMP = 1544582648735466220
+FOG_RATE = 1000
+ENCODER_RATE = 100
+LIDAR_RATE = 100
+STEREO_RATE = 10
+IMAGE_SHAPE = (560, 1280)
+STEREO_SHIFT = 16
+
+
+def make_world(size, n_obstacles, rng):
+    """
+    Square room with random boxes inside it
+    @param size: Side of the room in meters, the room is centered at the origin
+    @param n_obstacles: Number of boxes
+    @param rng: np.random.Generator
+    @return: (M, 4) wall segments [x0, y0, x1, y1]
+    """
+    half = size / 2
+    corners = [np.array([[-half, -half], [half, -half], [half, half], [-half, half]])]
+    centers = rng.uniform(-0.9 * half, 0.9 * half, (n_obstacles, 2))
+    sizes = rng.uniform(2, 10, (n_obstacles, 2))
+    for center, box in zip(centers, sizes):
+        corners.append(center + np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * box / 2)
+
+    segments = []
+    for polygon in corners:
+        segments.append(np.hstack((polygon, np.roll(polygon, -1, axis=0))))
+    return np.vstack(segments)
+
+
+def ray_cast(segments, origin, directions, max_range):
+    """
+    @param segments: (M, 4) wall segments
+    @param origin: (2,) start of the rays
+    @param directions: (N, 2) unit directions of the rays
+    @param max_range: Rays that hit nothing closer are returned as inf
+    @return: (N,) distance to the first hit
+    """
+    p = segments[:, :2] - origin
+    e = segments[:, 2:] - segments[:, :2]
+    denominator = directions[:, 0:1] * e[:, 1] - directions[:, 1:2] * e[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (p[:, 0] * e[:, 1] - p[:, 1] * e[:, 0]) / denominator
+        u = (p[:, 0] * directions[:, 1:2] - p[:, 1] * directions[:, 0:1]) / denominator
+    hit = (t > 0) & (u >= 0) & (u <= 1)
+    distances = np.min(np.where(hit, t, np.inf), axis=1)
+    distances[distances > max_range] = np.inf
+    return distances
+
+
+def make_trajectory(duration, speed, radius, rng):
+    """
+    A lap around a wobbly circle, sampled at the FOG rate
+    @return: times in seconds, x, y, theta and the left and right wheel distances
+    """
+    t = np.arange(int(duration * FOG_RATE) + 1) / FOG_RATE
+    wobble = rng.uniform(0.5, 1.5)
+    yaw_rate = speed / radius * (1 + 0.3 * np.sin(2 * np.pi * t * wobble / duration))
+    yaw_rate[t < 1] = 0
+    speeds = np.full(t.shape, speed)
+    speeds[t < 1] = 0
+
+    dt = 1 / FOG_RATE
+    theta = np.concatenate(([0], np.cumsum(yaw_rate[:-1] * dt)))
+    x = np.concatenate(([0], np.cumsum(speeds[:-1] * np.cos(theta[:-1]) * dt)))
+    y = np.concatenate(([0], np.cumsum(speeds[:-1] * np.sin(theta[:-1]) * dt)))
+    left = np.concatenate(([0], np.cumsum((speeds[:-1] - yaw_rate[:-1] * WHEEL_BASE / 2) * dt)))
+    right = np.concatenate(([0], np.cumsum((speeds[:-1] + yaw_rate[:-1] * WHEEL_BASE / 2) * dt)))
+    return t, x, y, theta, left, right
+
+
+def extract_params(output):
+    param_path = os.path.join(output, 'param')
+    with zipfile.ZipFile(PARAM_ZIP) as f:
+        f.extractall(param_path)
+
+
+def write_csv(filename, timestamp, data, fmt):
+    np.savetxt(filename, np.column_stack((timestamp.astype(object), data)), delimiter=',', fmt=['%d'] + [fmt] * data.shape[1])
+
+
+def write_stereo(output, timestamps, rng):
+    left_path = os.path.join(output, 'stereo_images', 'stereo_left')
+    right_path = os.path.join(output, 'stereo_images', 'stereo_right')
+    os.makedirs(left_path, exist_ok=True)
+    os.makedirs(right_path, exist_ok=True)
+    for ts in timestamps:
+        texture = cv2.resize(rng.integers(0, 256, (IMAGE_SHAPE[0] // 8, IMAGE_SHAPE[1] // 8), dtype=np.uint8), IMAGE_SHAPE[::-1])
+        cv2.imwrite(os.path.join(left_path, str(ts) + '.png'), texture)
+        cv2.imwrite(os.path.join(right_path, str(ts) + '.png'), np.roll(texture, -STEREO_SHIFT, axis=1))
+
+
+def generate_drive(output, duration=60, world_size=200, n_obstacles=60, speed=5, radius=40, stereo=False, seed=0, lidar_delay=0.0):
+    """
+    Writes a synthetic drive in the layout of ``data``: param, sensor_data and, optionally, stereo_images
+    @param output: Directory of the drive
+    @param duration: Length of the drive in seconds
+    @param world_size: Side of the room in meters
+    @param n_obstacles: Number of boxes in the room
+    @param speed: Speed of the vehicle in meters per second
+    @param radius: Radius of the lap in meters
+    @param stereo: Also write stereo image pairs
+    @param seed: Seed of the world, trajectory and images
+    @param lidar_delay: Seconds the lidar starts after the encoder and the FOG, the vehicle already moving
+    @return: Ground truth (K, 4) array of [timestamp, x, y, theta] at the lidar rate
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(output, 'sensor_data'), exist_ok=True)
+    extract_params(output)
+
+    segments = make_world(world_size, n_obstacles, rng)
+    segments[:, [1, 3]] += radius
+    t, x, y, theta, left, right = make_trajectory(duration, speed, radius, rng)
+    timestamps = START_TIMESTAMP + np.round(t * 1e9).astype(np.int64)
+
+    # FOG: delta roll, pitch and yaw of every sample
+    fog = np.zeros((t.shape[0], 3))
+    fog[1:, 2] = np.diff(theta)
+    write_csv(os.path.join(output, 'sensor_data', 'fog.csv'), timestamps, fog, '%.10e')
+
+    # Encoder: cumulative wheel ticks
+    step = FOG_RATE // ENCODER_RATE
+    ticks = np.column_stack((np.floor(left[::step] * ENCODER_RESOLUTION / (np.pi * LEFT_WHEEL_DIAMETER)),
+                             np.floor(right[::step] * ENCODER_RESOLUTION / (np.pi * RIGHT_WHEEL_DIAMETER)))) + 1000
+    write_csv(os.path.join(output, 'sensor_data', 'encoder.csv'), timestamps[::step], ticks, '%d')
+
+    # Lidar: the scan plane is tilted, so the range along a beam is longer than the planar distance to the wall
+    body = np.column_stack((np.cos(LIDAR_ANGLES), np.sin(LIDAR_ANGLES), np.zeros(LIDAR_ANGLES.shape[0]))) @ LIDAR_TO_VEHICLE_ROTATION.T
+    planar = np.linalg.norm(body[:, :2], axis=1)
+    body_directions = body[:, :2] / planar[:, np.newaxis]
+    step = FOG_RATE // LIDAR_RATE
+    index = np.arange(step // 2 + int(round(lidar_delay * FOG_RATE)), t.shape[0], step)
+    ranges = np.zeros((index.shape[0], LIDAR_ANGLES.shape[0]))
+    for i, k in enumerate(index):
+        c, s = np.cos(theta[k]), np.sin(theta[k])
+        directions = body_directions @ np.array([[c, s], [-s, c]])
+        distances = ray_cast(segments, np.array([x[k], y[k]]), directions, LIDAR_MAX_RANGE * planar.min()) / planar
+        ranges[i] = np.where(np.isfinite(distances), distances, 0)
+    write_csv(os.path.join(output, 'sensor_data', 'lidar.csv'), timestamps[index], ranges, '%.3f')
+
+    if stereo:
+        write_stereo(output, timestamps[FOG_RATE // STEREO_RATE::FOG_RATE // STEREO_RATE], rng)
+
+    return np.column_stack((timestamps[index], x[index], y[index], theta[index]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic drive generator')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Directory of the generated drive')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Length of the drive in seconds (default: 60)')
+    parser.add_argument('--obstacles', type=int, default=60,
+                        help='Number of boxes in the world (default: 60)')
+    parser.add_argument('--stereo', type=bool, default=False,
+                        help='Also generate stereo images (default: False)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generator (default: 0)')
+    parser.add_argument('--lidar-delay', type=float, default=0.0,
+                        help='Seconds the lidar starts after the odometry (default: 0)')
+
+    parameters = parser.parse_args()
+    ground_truth = generate_drive(parameters.output, duration=parameters.duration, n_obstacles=parameters.obstacles,
+                                  stereo=parameters.stereo, seed=parameters.seed,
+                                  lidar_delay=parameters.lidar_delay)
+    np.savetxt(os.path.join(parameters.output, 'ground_truth.csv'), ground_truth, delimiter=',', fmt=['%d', '%.6f', '%.6f', '%.6f'])
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+from TiledGrid import TILE_SIZE, TiledGrid
+
+# Checkpoint of the SLAM state:
+#   an .npz archive of named arrays, written compressed under a temporary name and renamed, so a checkpoint is either complete or missing.
+#   A tiled grid is stored as the (K, 2) keys of its tiles and the (K, TILE_SIZE, TILE_SIZE) stack of the tiles.
+CHECKPOINT_VERSION = 1
+
+
+def grid_state(name, grid):
+    """
+    @param name: Name of the grid in the checkpoint
+    @param grid: Dense array or TiledGrid
+    @return: Dict of the arrays of the grid
+    """
+    if isinstance(grid, TiledGrid):
+        keys = list(grid.tiles.keys())
+        tiles = np.stack([grid.tiles[key] for key in keys]) if keys else np.zeros((0, TILE_SIZE, TILE_SIZE) + grid.cell_shape, dtype=grid.dtype)
+        return {name + '/keys': np.array(keys, dtype=np.int64).reshape(-1, 2), name + '/tiles': tiles}
+    return {name: grid}
+
+
+def restore_grid(name, state, grid):
+    """
+    Copies a grid of the checkpoint into a grid of the same kind, dense grids are written in place
+    @param name: Name of the grid in the checkpoint
+    @param state: Dict of the arrays of the checkpoint
+    @param grid: Dense array or TiledGrid
+    """
+    if isinstance(grid, TiledGrid):
+        keys, tiles = state[name + '/keys'], state[name + '/tiles']
+        grid.tiles = {(int(tx), int(ty)): tile.copy() for (tx, ty), tile in zip(keys, tiles)}
+    else:
+        if grid.shape != state[name].shape:
+            raise ValueError("The grid " + name + " of the checkpoint does not match the map")
+        grid[...] = state[name]
+
+
+def save_checkpoint(filename, state):
+    """
+    @param filename: Path of the checkpoint
+    @param state: Dict of the arrays to save
+    """
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez_compressed(f, version=CHECKPOINT_VERSION, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+
+def load_checkpoint(filename):
+    """
+    @param filename: Path of the checkpoint
+    @return: Dict of the saved arrays
+    """
+    with np.load(filename) as data:
+        state = {key: data[key] for key in data.files}
+    if state.pop('version', None) != CHECKPOINT_VERSION:
+        raise ValueError(filename + " is not a checkpoint of this version")
+    return state
@@ -0,0 +1,23 @@
+import argparse
+import os
+
+from Sensors.sensor_log import convert_csv_to_log, log_path
+from Vehicle import DATA_PATH, SENSOR_LOG_DTYPES, data_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the csv sensor logs to memory mapped binary logs')
+    parser.add_argument('--force', type=bool, default=False,
+                        help='Convert the logs that have already been converted (default: False)')
+    parser.add_argument('--data-path', type=str, default=DATA_PATH,
+                        help='Data directory with the sensor_data of the drive (default: data)')
+
+    parameters = parser.parse_args()
+
+    for csv_file, dtype in SENSOR_LOG_DTYPES.items():
+        csv_file = data_file(parameters.data_path, csv_file)
+        binary_file = log_path(csv_file)
+        if os.path.isfile(binary_file) and not parameters.force:
+            print("Skipping " + csv_file + ", already converted")
+            continue
+        print("Converting " + csv_file)
+        convert_csv_to_log(csv_file, binary_file, dtype)
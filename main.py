@@ -1,6 +1,7 @@
 import argparse
 
-from Vehicle import Vehicle
+from Instrumentation import PROFILE_INTERVAL, STATS_EVERY
+from Vehicle import DATA_PATH, Vehicle
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Particle Filter by Ashish Farande')
@@ -10,12 +11,98 @@ if __name__ == '__main__':
                         help='Enable Dead Reckoning (default: False)')
     parser.add_argument('--particles', type=int, default=20,
                         help='Number of Particles (default: 20)')
+    parser.add_argument('--scan-matching', type=bool, default=False,
+                        help='Snap the particles to the best pose around them before weighting (default: False)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the random number generator of the particle filter (default: None)')
+    parser.add_argument('--resampling', choices=['systematic', 'stratified', 'residual'], default='stratified',
+                        help='Resampling scheme of the particle filter (default: stratified)')
+    parser.add_argument('--resample-threshold', type=float, default=0.5,
+                        help='Resample once the effective sample size drops below this fraction of the particles (default: 0.5)')
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help='The map correlation is divided by it before being added to the log weights (default: 1.0)')
+    parser.add_argument('--chunk-rows', type=int, default=None,
+                        help='Stream the sensor logs in chunks of this many rows instead of loading them at once (default: None)')
+    parser.add_argument('--tiled-map', type=bool, default=False,
+                        help='Store the map as tiles allocated on demand, so it grows without bounds (default: False)')
+    parser.add_argument('--map-odds-dtype', choices=['float64', 'int16', 'int8'], default='float64',
+                        help='Storage of the map log-odds, the integer ones are fixed-point and 4-8x smaller (default: float64)')
+    parser.add_argument('--coarse-level', type=int, default=0,
+                        help='Score the particles on this level of the map pyramid first, 0 disables it (default: 0)')
+    parser.add_argument('--refine-top-k', type=int, default=None,
+                        help='Number of the best coarse particles scored again at full resolution (default: a tenth of the particles)')
+    parser.add_argument('--observation-model', choices=['hits', 'likelihood'], default='hits',
+                        help='Weight the particles by the beams ending in occupied cells or by the likelihood field of the map (default: hits)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of workers scoring the particles in parallel (default: 1)')
+    parser.add_argument('--parallel-mode', choices=['thread', 'process'], default='thread',
+                        help='Score with a thread pool or with a process pool sharing the map through shared memory (default: thread)')
+    parser.add_argument('--pipeline', type=bool, default=False,
+                        help='Read the sensors and process the stereo frames in background threads, ahead of the filter (default: False)')
+    parser.add_argument('--texture-step', type=int, default=1,
+                        help='Only every texture-step-th row and column of the stereo frames is texture mapped (default: 1)')
+    parser.add_argument('--stereo-prefetch', type=bool, default=False,
+                        help='Read and convert the next stereo images in a background thread (default: False)')
+    parser.add_argument('--keyframe-distance', type=float, default=0.0,
+                        help='Only texture map a stereo frame once the vehicle moved this many meters since the last one, 0 disables it (default: 0)')
+    parser.add_argument('--keyframe-rotation', type=float, default=0.0,
+                        help='Or once the vehicle turned this many radians since the last one, 0 disables it (default: 0)')
+    parser.add_argument('--texture-budget', type=float, default=None,
+                        help='Seconds of texture mapping allowed per second of drive, frames over the budget are skipped (default: None)')
+    parser.add_argument('--display', choices=['none', 'window', 'thread'], default='window',
+                        help='Show the map while driving in a window, from a background thread, or not at all for headless runs (default: window)')
+    parser.add_argument('--display-every', type=int, default=100,
+                        help='Number of iterations between two refreshes of the display (default: 100)')
+    parser.add_argument('--snapshot-dir', type=str, default=None,
+                        help='Write snapshots of the occupancy and texture images and of the trajectory to this directory (default: None)')
+    parser.add_argument('--snapshot-every', type=int, default=100,
+                        help='Number of iterations between two snapshots (default: 100)')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Periodically save the state of the drive to this file (default: None)')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='Number of iterations between two checkpoints (default: 1000)')
+    parser.add_argument('--data-path', type=str, default=DATA_PATH,
+                        help='Data directory of the drive, laid out like data (default: data)')
+    parser.add_argument('--stats', choices=['none', 'log', 'json'], default='none',
+                        help='Report the timers, counters and histograms of the stages as a log line or as JSON lines (default: none)')
+    parser.add_argument('--stats-file', type=str, default=None,
+                        help='File the JSON lines of the statistics are appended to (default: None)')
+    parser.add_argument('--stats-every', type=int, default=STATS_EVERY,
+                        help='Number of iterations between two reports of the statistics (default: {})'.format(STATS_EVERY))
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Sample the stacks while driving and write them as folded stacks to this file (default: None)')
+    parser.add_argument('--profile-interval', type=float, default=PROFILE_INTERVAL,
+                        help='Seconds between two samples of the stacks (default: {})'.format(PROFILE_INTERVAL))
+    parser.add_argument('--precompute-scans', type=bool, default=False,
+                        help='Convert all the lidar scans to end points when starting, about 24 bytes per beam (default: False)')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Resume the drive from this checkpoint, with the same parameters as the checkpointed drive (default: None)')
 
     parameters = parser.parse_args()
 
-    my_car = Vehicle(n_particles=parameters.particles, enable_texture_mapping=parameters.texture_map, enable_dead_reckoning=parameters.dead_reckoning)
+    my_car = Vehicle(n_particles=parameters.particles, enable_texture_mapping=parameters.texture_map, enable_dead_reckoning=parameters.dead_reckoning,
+                     enable_scan_matching=parameters.scan_matching, seed=parameters.seed,
+                     resampling=parameters.resampling, resample_threshold=parameters.resample_threshold,
+                     temperature=parameters.temperature, chunk_rows=parameters.chunk_rows,
+                     tiled_map=parameters.tiled_map, map_odds_dtype=parameters.map_odds_dtype,
+                     coarse_level=parameters.coarse_level, refine_top_k=parameters.refine_top_k,
+                     observation_model=parameters.observation_model,
+                     n_workers=parameters.workers, parallel_mode=parameters.parallel_mode,
+                     pipeline=parameters.pipeline, texture_step=parameters.texture_step,
+                     stereo_prefetch=parameters.stereo_prefetch, keyframe_distance=parameters.keyframe_distance,
+                     keyframe_rotation=parameters.keyframe_rotation, texture_budget=parameters.texture_budget,
+                     display=parameters.display, display_every=parameters.display_every,
+                     snapshot_dir=parameters.snapshot_dir, snapshot_every=parameters.snapshot_every,
+                     checkpoint_path=parameters.checkpoint, checkpoint_every=parameters.checkpoint_every,
+                     data_path=parameters.data_path, stats=parameters.stats, stats_file=parameters.stats_file,
+                     stats_every=parameters.stats_every, profile_path=parameters.profile, profile_interval=parameters.profile_interval,
+                     precompute_scans=parameters.precompute_scans)
 
-    my_car.start()
-    my_car.drive()
+    # The workers and their shared memory are released even if the drive fails
+    try:
+        my_car.start(checkpoint=parameters.resume)
+        my_car.drive()
+    finally:
+        my_car.stop()
 
     my_car.show_map()
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def effective_sample_size(weights):
+    """
+    @param weights: Normalised particle weights
+    @return: N_eff = 1 / sum(w^2)
+    """
+    return 1.0 / np.dot(weights, weights)
+
+
+def _search(weights, positions):
+    cum = np.cumsum(weights)
+    cum[-1] = 1.0
+    return np.minimum(np.searchsorted(cum, positions, side='right'), weights.shape[0] - 1)
+
+
+def systematic_resample(weights, n, rng):
+    """
+    One uniform offset shared by n evenly spaced positions.
+    @param weights: Normalised particle weights
+    @param n: Number of particles to draw
+    @param rng: np.random.Generator
+    @return: (n,) indices of the drawn particles
+    """
+    positions = (rng.random() + np.arange(n)) / n
+    return _search(weights, positions)
+
+
+def stratified_resample(weights, n, rng):
+    """
+    One uniform draw inside each of the n equal strata of [0, 1).
+    @param weights: Normalised particle weights
+    @param n: Number of particles to draw
+    @param rng: np.random.Generator
+    @return: (n,) indices of the drawn particles
+    """
+    positions = (rng.random(n) + np.arange(n)) / n
+    return _search(weights, positions)
+
+
+def residual_resample(weights, n, rng):
+    """
+    Keeps floor(n * w) copies of every particle and draws the rest with stratified resampling on the residual weights.
+    @param weights: Normalised particle weights
+    @param n: Number of particles to draw
+    @param rng: np.random.Generator
+    @return: (n,) indices of the drawn particles
+    """
+    scaled = n * weights
+    counts = np.floor(scaled).astype(np.int64)
+    indices = np.repeat(np.arange(weights.shape[0]), counts)
+
+    n_residual = n - indices.shape[0]
+    if n_residual > 0:
+        residual = scaled - counts
+        residual /= np.sum(residual)
+        indices = np.concatenate((indices, stratified_resample(residual, n_residual, rng)))
+    return indices
+
+
+RESAMPLERS = {
+    'systematic': systematic_resample,
+    'stratified': stratified_resample,
+    'residual': residual_resample,
+}